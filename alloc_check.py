@@ -0,0 +1,170 @@
+"""on-device check that the measurement loops do not allocate
+
+runs the step() methods that the live HR, HRV capture and PPG stream loops call on every pass, on a synthetic
+signal with the sensor fifo, display, switch and mqtt swapped for fakes and a clock advancing one sample
+period per sample. gc.mem_alloc() must stay flat over N passes. the garbage collector is disabled while
+measuring, so every allocation shows up. passes that refresh the texts on the display are left out, they
+format strings by design and collect right after.
+
+install the project first, then run from the repository root:
+    mpremote run alloc_check.py
+"""
+import gc
+import math
+import time
+from array import array
+
+from measurement import LiveHRMeasurement, AnalysisMeasurement, StreamMeasurement
+
+ITERATIONS = 2000
+WARMUP = 200 # passes before measuring, so one-time setup such as the first full stream chunk is not counted
+MAX_GROWTH_BYTES = 64
+SAMPLES_PER_ITERATION = 3 # a loop pass drains a few samples, like on the device
+PASS_MS = SAMPLES_PER_ITERATION * 4 # 250Hz
+
+def synthetic_signal(seconds = 10, bpm = 75):
+    """ppg-like pulses at 250Hz"""
+    samples = array('H', [0] * (seconds * 250))
+    period = 250 * 60 // bpm
+    for i in range(len(samples)):
+        phase = (i % period) / 250
+        pulse = 4000 * math.exp(-((phase - 0.15) / 0.07) ** 2) + 1000 * math.exp(-((phase - 0.4) / 0.08) ** 2)
+        samples[i] = 30000 + int(pulse)
+    return samples
+
+class FakeFifo:
+    """SensorFifo interface, replaying a signal a few samples per loop pass"""
+    def __init__(self, signal):
+        self.signal = signal
+        self.pos = 0
+        self.available = 0
+        self.last_gap = 0
+        self.dc = 0
+        self.recording = True
+
+    def refill(self):
+        self.available = SAMPLES_PER_ITERATION
+
+    def has_data(self):
+        return self.available > 0
+
+    def get(self):
+        self.available -= 1
+        value = self.signal[self.pos]
+        self.pos = (self.pos + 1) % len(self.signal)
+        return value
+
+    def reset(self):
+        self.available = 0
+
+class FakeDisplay:
+    """records whether texts were drawn, those passes allocate by design"""
+    width = 128
+    height = 64
+    refreshed = False
+
+    def draw_ppg_graph(self, value, min_val, max_val):
+        pass
+
+    def centered_texts(self, texts):
+        self.refreshed = True
+
+    def texts(self, texts):
+        self.refreshed = True
+
+    def heading(self, *args, **kwargs):
+        self.refreshed = True
+
+    def clear(self):
+        pass
+
+class FakeSwitch:
+    def single_press(self):
+        return False
+
+class FakeMQTT:
+    device_id = "check"
+    stream_topic = "ppg-stream/check"
+    is_connected = True
+
+    def publish(self, topic, data, retry = True):
+        return True
+
+    def set_timeout(self, seconds):
+        pass
+
+def measure(name, measurement, step):
+    """run step(now) of a measurement whose fifo, display and switch are fakes"""
+    fifo = measurement.fifo
+    display = measurement.display
+    now = 0
+    for _ in range(WARMUP):
+        now += PASS_MS
+        fifo.refill()
+        if not step(now):
+            print(f"{name}: the loop ended during the warmup FAIL")
+            return False
+
+    growth = 0
+    refreshes = 0
+    running = True
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(ITERATIONS):
+            now += PASS_MS
+            fifo.refill()
+            display.refreshed = False
+            before = gc.mem_alloc()
+            running = step(now)
+            if display.refreshed:
+                refreshes += 1
+            else:
+                growth += gc.mem_alloc() - before
+            if not running:
+                break
+    finally:
+        gc.enable()
+
+    ok = running and growth <= MAX_GROWTH_BYTES
+    print(f"{name}: {growth} bytes over {ITERATIONS - refreshes} iterations, "
+          f"{refreshes} display refreshes left out {'ok' if ok else 'FAIL'}")
+    if not running:
+        print(f"{name}: the loop ended early")
+    return ok
+
+def live_measurement(signal):
+    live = LiveHRMeasurement(FakeDisplay(), FakeSwitch(), 16)
+    live.fifo = FakeFifo(signal)
+    live.detector.reset()
+    live.window.reset()
+    live.start(0)
+    return live
+
+def capture_measurement(signal):
+    hrv = AnalysisMeasurement(FakeDisplay(), FakeSwitch(), 16, mqtt_handler = FakeMQTT())
+    hrv.fifo = FakeFifo(signal)
+    hrv.start_capture(0) # ITERATIONS + WARMUP passes stay within the capture duration
+    return hrv
+
+def stream_measurement(signal):
+    stream = StreamMeasurement(FakeDisplay(), FakeSwitch(), 16, mqtt_handler = FakeMQTT())
+    stream.fifo = FakeFifo(signal)
+    stream.streamer.start(1)
+    stream.last_status = 0
+    return stream
+
+def main():
+    signal = synthetic_signal()
+    live = live_measurement(signal)
+    hrv = capture_measurement(signal)
+    stream = stream_measurement(signal)
+    results = [
+        measure("live HR loop", live, live.step),
+        measure("HRV capture loop", hrv, hrv.capture_step),
+        measure("PPG stream loop", stream, stream.step),
+    ]
+    assert all(results), "a measurement loop allocates"
+    print("all loops allocation free")
+
+main()
@@ -0,0 +1,257 @@
+import math
+
+# the signal analysis used by the measurements. no hardware imports, so the same code also runs on a
+# computer, see tools/batch_analyze.py
+#
+# the element loops can run on an array backend: ulab on firmware that includes it, numpy on a computer.
+# the plain python code is the reference and the fallback, and every backend gives identical results
+
+try:
+    from ulab import numpy as _ulab
+except ImportError:
+    _ulab = None
+
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+SAMPLE_INTERVAL_MS = 4 # 250Hz
+PPI_THRESHOLD_MIN = 150 # these might need some tweaking still
+PPI_THRESHOLD_MAX = 2000
+RMSSD_DIFF_CAP_MS = 250
+MIN_HRV_PPI_COUNT = 10 # fewer intervals than this is not enough for an hrv analysis
+MAX_CORRECTED_GAP = 5 # lost samples an interval can be corrected for, a longer gap might hide a beat
+
+def average(values):
+    return round(sum(values) / len(values)) if values else 0
+
+def stddev(values):
+    if len(values) < 2:
+        return 0
+    avg = average(values)
+    variance = sum((x - avg) ** 2 for x in values) / (len(values) - 1)
+    return variance ** 0.5
+
+class PythonBackend:
+    """plain python element loops, the reference implementation"""
+    name = "python"
+
+    def summary(self, samples, count):
+        """(sum, max, min) of the first count samples, in one pass without slicing the buffer"""
+        total = 0
+        high = low = samples[0]
+        for i in range(count):
+            value = samples[i]
+            total += value
+            if value > high:
+                high = value
+            elif value < low:
+                low = value
+        return total, high, low
+
+    def crossings(self, samples, count, threshold):
+        peaks = []
+        for i in range(count - 1):
+            if samples[i] <= threshold <= samples[i + 1]:
+                peaks.append(i + 1)
+        return peaks
+
+    def intervals(self, peaks, min_ppi, max_ppi):
+        output = []
+        for i in range(len(peaks) - 1):
+            ppi = (peaks[i + 1] - peaks[i]) * SAMPLE_INTERVAL_MS
+
+            if min_ppi < ppi < max_ppi:
+                output.append(ppi)
+        return output
+
+    def sums(self, ppi_list):
+        """(sum(x), sum(x^2)) as exact integers"""
+        total = squares = 0
+        for x in ppi_list:
+            total += x
+            squares += x * x
+        return total, squares
+
+    def diff_squares(self, ppi_list, cap):
+        """sum of the squared successive differences, each difference capped"""
+        squares = 0
+        for i in range(len(ppi_list) - 1):
+            diff = min(abs(ppi_list[i + 1] - ppi_list[i]), cap)
+            squares += diff * diff
+        return squares
+
+class ArrayBackend(PythonBackend):
+    """vectorized element loops on numpy or ulab.
+    the comparisons are exact on both. ulab only has float32, so the integer sums of the statistics
+    stay in python there, they are over a few dozen intervals anyway"""
+    def __init__(self, np, name, exact_sums):
+        self.np = np
+        self.name = name
+        self.exact_sums = exact_sums
+
+    def as_array(self, samples, count):
+        if isinstance(samples, list):
+            return self.np.array(samples[:count], dtype = self.np.uint16)
+        return self.np.frombuffer(samples, dtype = self.np.uint16, count = count) # array('H') buffer, no copy
+
+    def summary(self, samples, count):
+        if not self.exact_sums:
+            # the builtins run in C and stay exact on integers
+            values = samples[:count] if isinstance(samples, list) else memoryview(samples)[:count]
+            return sum(values), max(values), min(values)
+        values = self.as_array(samples, count)
+        return int(values.sum(dtype = self.np.int64)), int(values.max()), int(values.min())
+
+    def crossings(self, samples, count, threshold):
+        if count < 2:
+            return []
+        try:
+            values = self.as_array(samples, count)
+            # the samples are integers, so samples[i] <= threshold <= samples[i + 1] holds exactly when
+            # samples[i] <= floor(threshold) and samples[i + 1] >= ceil(threshold). comparing the uint16 samples
+            # with integers gives byte masks, instead of float32 differences four times the size of the capture
+            rising = (values[:-1] <= math.floor(threshold)) * (values[1:] >= math.ceil(threshold))
+            return [int(i) + 1 for i in self.np.nonzero(rising)[0]]
+        except MemoryError:
+            # a fragmented heap after a long session, the python loop needs no buffers
+            return PythonBackend.crossings(self, samples, count, threshold)
+
+    def intervals(self, peaks, min_ppi, max_ppi):
+        if len(peaks) < 2:
+            return []
+        ppi = self.np.diff(self.np.array(peaks)) * SAMPLE_INTERVAL_MS
+        ppi = ppi[ppi > min_ppi]
+        ppi = ppi[ppi < max_ppi]
+        return [int(x) for x in ppi]
+
+    def sums(self, ppi_list):
+        if not self.exact_sums:
+            return PythonBackend.sums(self, ppi_list)
+        values = self.np.array(ppi_list, dtype = self.np.int64)
+        return int(values.sum()), int((values * values).sum())
+
+    def diff_squares(self, ppi_list, cap):
+        if not self.exact_sums or len(ppi_list) < 2:
+            return PythonBackend.diff_squares(self, ppi_list, cap)
+        diffs = self.np.minimum(self.np.abs(self.np.diff(self.np.array(ppi_list, dtype = self.np.int64))), cap)
+        return int((diffs * diffs).sum())
+
+def available_backends():
+    backends = {"python": PythonBackend()}
+    if _ulab is not None and hasattr(_ulab, "nonzero"):
+        backends["ulab"] = ArrayBackend(_ulab, "ulab", exact_sums = False)
+    if _numpy is not None:
+        backends["numpy"] = ArrayBackend(_numpy, "numpy", exact_sums = True)
+    return backends
+
+_backends = available_backends()
+_backend = _backends.get("ulab") or _backends.get("numpy") or _backends["python"]
+
+def set_backend(name):
+    """pick the backend by name: "python", "numpy", "ulab" or "auto" for the fastest available"""
+    global _backend
+    if name == "auto":
+        _backend = _backends.get("ulab") or _backends.get("numpy") or _backends["python"]
+    elif name in _backends:
+        _backend = _backends[name]
+    else:
+        raise ValueError(f"Backend {name} is not available, use one of {sorted(_backends)}")
+
+def backend_name():
+    return _backend.name
+
+def get_peaks(samples, count = None):
+    """count limits the search to the first samples of a preallocated buffer"""
+    if count is None:
+        count = len(samples)
+    if count < 1:
+        return []
+
+    total, high, low = _backend.summary(samples, count)
+    threshold = round(total / count) + (high - low) / 5
+
+    return _backend.crossings(samples, count, threshold)
+
+def get_ppi(peaks, min_ppi = PPI_THRESHOLD_MIN, max_ppi = PPI_THRESHOLD_MAX):
+    return _backend.intervals(peaks, min_ppi, max_ppi)
+
+def get_ppi_with_gaps(peaks, gaps, min_ppi = PPI_THRESHOLD_MIN, max_ppi = PPI_THRESHOLD_MAX, max_gap = MAX_CORRECTED_GAP):
+    """get_ppi for a capture with lost samples. gaps are (position, length) pairs in capture order: length
+    samples were lost right before samples[position]. an interval over short gaps is lengthened by the lost
+    samples, one over a longer gap is dropped since a beat may be lost in it.
+    returns (ppi, corrected, discarded)"""
+    if not gaps:
+        return get_ppi(peaks, min_ppi, max_ppi), 0, 0
+
+    output = []
+    corrected = discarded = 0
+    j = 0
+    after_long_gap = False # the beat starting the interval came right after a long gap, its timing is unknown
+
+    for i in range(len(peaks) - 1):
+        start = peaks[i]
+        end = peaks[i + 1]
+        lost = 0
+        drop = after_long_gap
+        after_long_gap = False
+
+        while j < len(gaps) and gaps[j][0] <= end:
+            position, length = gaps[j]
+            j += 1
+            if position < start:
+                continue # before the first beat
+            if length > max_gap:
+                drop = True
+                after_long_gap = position == end
+            if position > start:
+                lost += length
+
+        if drop:
+            discarded += 1
+            continue
+
+        ppi = (end - start + lost) * SAMPLE_INTERVAL_MS
+        if min_ppi < ppi < max_ppi:
+            output.append(ppi)
+            if lost:
+                corrected += 1
+
+    return output, corrected, discarded
+
+def ppi_limits(typical_ppi):
+    """(min, max) accepted interval around a known typical interval: half to double of it, within
+    the fixed thresholds. the fixed thresholds when there is no typical interval"""
+    if not typical_ppi:
+        return PPI_THRESHOLD_MIN, PPI_THRESHOLD_MAX
+    return max(PPI_THRESHOLD_MIN, typical_ppi // 2), min(PPI_THRESHOLD_MAX, typical_ppi * 2)
+
+def mean_ppi(ppi_list):
+    return int(round(sum(ppi_list) / len(ppi_list)))
+
+def mean_hr(mean_ppi):
+    return int(round(60000 / mean_ppi))
+
+def sdnn(ppi_list):
+    # exact integer sums: var = (n * sum(x^2) - sum(x)^2) / (n * (n - 1))
+    n = len(ppi_list)
+    total, squares = _backend.sums(ppi_list)
+    var = (n * squares - total * total) / (n * (n - 1))
+    return math.sqrt(var)
+
+def rmssd(ppi_list):
+    squares = _backend.diff_squares(ppi_list, RMSSD_DIFF_CAP_MS) # differences capped
+    mean_sq = squares / (len(ppi_list) - 1)
+    return math.sqrt(mean_sq)
+
+def calculate_hrv(ppi_list):
+    """locally calculates wanted HRV parameters from ppi data"""
+    mean = mean_ppi(ppi_list)
+
+    return {
+        "mean_ppi": mean,
+        "mean_hr": mean_hr(mean),
+        "sdnn": sdnn(ppi_list),
+        "rmssd": rmssd(ppi_list),
+    }
@@ -0,0 +1,68 @@
+import ujson
+
+import analysis
+
+class Baseline:
+    """signal levels and the typical beat interval of the last good session, saved to flash.
+    the continuous live HR and the HRV capture start their beat detector from these instead of from scratch,
+    the windowed live HR has no beat detector. the interval limits derived from the typical interval reject
+    notches until the crossings show a different rhythm, then the fixed limits return"""
+    MIN_LEVEL_SPAN = 100 # below this the saved levels say nothing about the signal
+
+    def __init__(self, path = "baseline.json"):
+        self.path = path
+        self._data = None
+        self._loaded = False
+
+    def load(self):
+        """the saved baseline, or None if there is no usable one. read from flash only once"""
+        if self._loaded:
+            return self._data
+        self._loaded = True
+
+        try:
+            with open(self.path) as f:
+                data = ujson.load(f)
+            if self._valid(data["mean"], data["high"], data["low"], data["ppi"]):
+                self._data = data
+        except OSError:
+            pass # no baseline saved yet
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring invalid baseline: {e}")
+
+        return self._data
+
+    def _valid(self, mean, high, low, ppi):
+        return (
+            high - low >= self.MIN_LEVEL_SPAN and low <= mean <= high and
+            analysis.PPI_THRESHOLD_MIN < ppi < analysis.PPI_THRESHOLD_MAX
+        )
+
+    def prime(self, detector):
+        """warm-start a BeatDetector, returns True if there was a baseline to start from"""
+        data = self.load()
+        if not data:
+            return False
+
+        detector.prime(data["mean"], data["high"], data["low"])
+        detector.set_limits(*analysis.ppi_limits(data["ppi"]))
+        return True
+
+    def save(self, detector, typical_ppi):
+        """store the current levels of the detector and the typical interval of a good session"""
+        mean = detector.mean()
+        if not self._valid(mean, detector.high, detector.low, typical_ppi):
+            print("Signal levels not saved as baseline")
+            return False
+
+        data = {"mean": mean, "high": detector.high, "low": detector.low, "ppi": typical_ppi}
+        try:
+            with open(self.path, "w") as f:
+                ujson.dump(data, f)
+        except OSError as e:
+            print(f"Error saving baseline: {e}")
+            return False
+
+        self._data = data
+        self._loaded = True
+        return True
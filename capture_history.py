@@ -1,36 +1,29 @@
-import os
 import ujson
 import time
 from utils import wait_for_press
 from components.Switch import Button
 from machine import Pin
 from menu import Menu
+from history_store import HistoryStore
 
 class History:
-    def __init__(self, display, switch, rot, history_dir="history"):
+    def __init__(self, display, switch, rot, history_dir="history", store = None):
         self.display = display
         self.switch = switch
         self.rot = rot
         self.next_page_loader = Button(9, Pin.IN, Pin.PULL_UP)
         self.history_dir = history_dir
+        self.store = store if store else HistoryStore(history_dir)
         
         self.entries_per_page = 5
         self.entries = self.load_entries()
         self.total_pages = self.get_page_count()
         self.page = 0
 
-        # create the history directory if it does not exist
-        if not os.path.exists(self.history_dir):
-            os.makedirs(self.history_dir, exist_ok=True)
-
     def load_entries(self):
         try:
-            files = sorted(os.listdir(self.history_dir), reverse=True)
-            
-            if len(files) < 1:
-                return []
-            
-            return files
+            # the store creates the history directory if it does not exist
+            return self.store.entries()
         except Exception as e:
             print(f"Error loading history: {e}")
             return []
@@ -40,7 +33,7 @@ class History:
         unwanted_fields = ("id", "timestamp", "type")
         
         try:
-            with open(f"{self.history_dir}/{filename}") as f:
+            with open(f"{self.store.directory}/{filename}") as f:
                 data = ujson.load(f)
             
             self.display.fill(0)
@@ -94,6 +87,7 @@ class History:
         
     def run(self):
         self.entries = self.load_entries()
+        self.total_pages = self.get_page_count()
         
         self.display.centered_texts([
             "Show history",
@@ -0,0 +1,177 @@
+import struct
+import binascii
+
+# compact binary wire format for the MQTT payloads. shared by the device and the host-side bridge,
+# so keep this module free of MicroPython-only imports.
+#
+# every compact payload starts with a version byte. compact payloads are published on
+# "<topic>/bin" so the json topics stay untouched for clients that don't understand them.
+
+VERSION = 3 # version 2 added the device id to hr-data, version 3 the lost sample count to stream chunks
+SUPPORTED_VERSIONS = (1, 2, 3)
+COMPACT_SUFFIX = "/bin"
+CAPS_TOPIC = "codec-caps" # retained message from the bridge listing the topics it can decode
+
+RRI_TYPE = "RRI"
+ANALYSIS_TYPES = ("readiness",)
+HR_TYPES = ("local", "kubios")
+
+# version, id, timestamp, type, mean_ppi, mean_hr, sdnn, rmssd, sns * 1000, pns * 1000, device id
+HR_RECORD = "<BIIBHHHHii8s"
+HR_RECORD_V1 = "<BIIBHHHHii" # without the device id
+MISSING = -2147483648 # sns/pns are "---" for local analysis
+NO_DEVICE = "0000000000000000"
+
+def compact_topic(topic):
+    return topic + COMPACT_SUFFIX
+
+def _check_version(data):
+    if not data or data[0] not in SUPPORTED_VERSIONS:
+        raise ValueError(f"Unsupported payload version: {data[0] if data else None}")
+
+def write_varint(buf, value):
+    """append an unsigned LEB128 varint to a bytearray"""
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+def read_varint(data, pos):
+    """read an unsigned LEB128 varint, returns (value, next position)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+def encode_ppi(buf, ppi):
+    """delta encode a ppi list as zigzag varints. consecutive intervals are close, so most deltas fit in a byte"""
+    write_varint(buf, len(ppi))
+    previous = 0
+    for value in ppi:
+        write_varint(buf, zigzag(value - previous))
+        previous = value
+
+def decode_ppi(data, pos):
+    count, pos = read_varint(data, pos)
+    ppi = []
+    previous = 0
+    for _ in range(count):
+        delta, pos = read_varint(data, pos)
+        previous += unzigzag(delta)
+        ppi.append(previous)
+    return ppi, pos
+
+def encode_kubios_request(payload):
+    buf = bytearray()
+    buf.append(VERSION)
+    buf.extend(struct.pack("<IB", payload["id"], ANALYSIS_TYPES.index(payload["analysis"]["type"])))
+    encode_ppi(buf, payload["data"])
+    return buf
+
+def decode_kubios_request(data):
+    _check_version(data)
+    m_id, analysis_type = struct.unpack_from("<IB", data, 1)
+    ppi, _ = decode_ppi(data, 6)
+
+    return {
+        "id": m_id,
+        "type": RRI_TYPE,
+        "data": ppi,
+        "analysis": {
+            "type": ANALYSIS_TYPES[analysis_type]
+        }
+    }
+
+def _pack_index(value):
+    return MISSING if value == "---" else int(round(value * 1000))
+
+def _unpack_index(value):
+    return "---" if value == MISSING else round(value / 1000, 3)
+
+def encode_hr_data(data):
+    return struct.pack(
+        HR_RECORD,
+        VERSION,
+        data["id"],
+        data["timestamp"],
+        HR_TYPES.index(data["type"]),
+        data["mean_ppi"],
+        data["mean_hr"],
+        data["sdnn"],
+        data["rmssd"],
+        _pack_index(data["sns"]),
+        _pack_index(data["pns"]),
+        binascii.unhexlify(data.get("device", NO_DEVICE)),
+    )
+
+def decode_hr_data(data):
+    _check_version(data)
+    if data[0] == 1:
+        fields = struct.unpack(HR_RECORD_V1, data) + (None,)
+    else:
+        fields = struct.unpack(HR_RECORD, data)
+
+    decoded = {
+        "id": fields[1],
+        "timestamp": fields[2],
+        "type": HR_TYPES[fields[3]],
+        "mean_ppi": fields[4],
+        "mean_hr": fields[5],
+        "sdnn": fields[6],
+        "rmssd": fields[7],
+        "sns": _unpack_index(fields[8]),
+        "pns": _unpack_index(fields[9]),
+    }
+    if fields[10] is not None and fields[10] != binascii.unhexlify(NO_DEVICE):
+        decoded["device"] = binascii.hexlify(fields[10]).decode()
+    return decoded
+
+# raw ppg stream chunk: version, flags, session, sequence number, sample count, samples lost on the device,
+# index of the first sample after the loss, then count * uint16 samples
+STREAM_HEADER = "<BBHIHHH"
+STREAM_HEADER_SIZE = 14
+STREAM_HEADER_V2 = "<BBHIH" # without the lost samples
+STREAM_HEADER_SIZE_V2 = 10
+STREAM_END = 0x01 # flag on the last chunk of a session
+STREAM_GAP = 0x02 # flag on a chunk with samples lost on the device before lost_at
+MAX_LOST = 0xFFFF
+
+def pack_stream_header(buf, session, seq, count, flags = 0, lost = 0, lost_at = 0):
+    if lost:
+        flags |= STREAM_GAP
+    struct.pack_into(STREAM_HEADER, buf, 0, VERSION, flags, session, seq, count, min(lost, MAX_LOST), lost_at)
+
+def unpack_stream_chunk(data):
+    """returns (session, seq, flags, samples, lost, lost_at)"""
+    _check_version(data)
+    if data[0] < 3:
+        _, flags, session, seq, count = struct.unpack_from(STREAM_HEADER_V2, data, 0)
+        lost, lost_at, offset = 0, 0, STREAM_HEADER_SIZE_V2
+    else:
+        _, flags, session, seq, count, lost, lost_at = struct.unpack_from(STREAM_HEADER, data, 0)
+        offset = STREAM_HEADER_SIZE
+    if len(data) < offset + count * 2:
+        raise ValueError(f"Truncated chunk: {len(data)} bytes for {count} samples")
+    samples = list(struct.unpack_from(f"<{count}H", data, offset))
+    return session, seq, flags, samples, lost, lost_at
+
+ENCODERS = {
+    "kubios-request": encode_kubios_request,
+    "hr-data": encode_hr_data,
+}
+
+DECODERS = {
+    "kubios-request": decode_kubios_request,
+    "hr-data": decode_hr_data,
+}
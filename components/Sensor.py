@@ -1,18 +1,58 @@
 from machine import ADC
 from fifo import Fifo
+from array import array
 
 class SensorFifo(Fifo):
+    """fifo filled by the sampling timer. samples that do not fit are lost, so every gap is stamped with the
+    number of samples written before it, and get() reports in last_gap how many samples were lost right
+    before the sample it returns"""
+    GAP_SLOTS = 16 # gaps waiting to be read, allocated up front since handler runs in the timer interrupt
+
     def __init__(self, size, pin = 26):
         super().__init__(size)
         self.sensor = ADC(pin)
         self.recording = False
-        
+        self.gap_pos = array('L', [0] * self.GAP_SLOTS)
+        self.gap_len = array('L', [0] * self.GAP_SLOTS)
+        self.reset()
+
     def handler(self, tid):
         if self.recording:
+            head = self.head
             self.put(self.sensor.read_u16())
-            
+            if self.head == head: # full, the sample was dropped
+                self.missing += 1 # put() counted it in dc too
+                return
+
+            if self.missing:
+                next_write = (self.gap_write + 1) % self.GAP_SLOTS
+                if next_write == self.gap_read:
+                    # no free slot, add to the newest gap. the total lost time stays right, only its position is off
+                    self.gap_len[(self.gap_write - 1) % self.GAP_SLOTS] += self.missing
+                else:
+                    self.gap_pos[self.gap_write] = self.written
+                    self.gap_len[self.gap_write] = self.missing
+                    self.gap_write = next_write
+                self.missing = 0
+            self.written += 1
+
+    def get(self):
+        """the next sample. last_gap is the number of samples lost right before it"""
+        self.last_gap = 0
+        if self.gap_read != self.gap_write and self.gap_pos[self.gap_read] == self.read_count:
+            self.last_gap = self.gap_len[self.gap_read]
+            self.gap_read = (self.gap_read + 1) % self.GAP_SLOTS
+        self.read_count += 1
+        return super().get()
+
     def reset(self):
         """Clear the FIFO state, making it empty."""
         self.head = 0
         self.tail = 0
         self.dc = 0
+        self.written = 0 # samples stored since the reset, the sequence stamp of the next one
+        self.read_count = 0
+        self.missing = 0 # samples dropped since the last stored one, dc counts all since the reset
+        self.gap_write = 0
+        self.gap_read = 0
+        self.last_gap = 0
@@ -0,0 +1,298 @@
+from array import array
+
+import analysis
+
+class BeatDetector:
+    """incremental version of get_peaks, finds beats one sample at a time.
+    uses the same average + (max - min) / 5 threshold, but the average and the min/max are kept as
+    decaying envelopes instead of being recomputed over a window. integer math only"""
+    SAMPLE_INTERVAL_MS = analysis.SAMPLE_INTERVAL_MS
+    MEAN_SHIFT = 8 # average follows the signal with a ~1s time constant
+    ENVELOPE_SHIFT = 9 # min/max decay towards the average in ~2s
+    PRIOR_WEIGHT = 64 # levels from an earlier session count as a quarter second of samples
+    MAX_CORRECTED_GAP = analysis.MAX_CORRECTED_GAP # same gap rule as get_ppi_with_gaps
+    MAX_MISFITS = 4 # a crossing only narrowed limits reject counts 2 and a fitting interval -1, at this the defaults return
+
+    def __init__(self, min_ppi_ms = analysis.PPI_THRESHOLD_MIN, max_ppi_ms = analysis.PPI_THRESHOLD_MAX):
+        self.default_min_ppi_ms = min_ppi_ms
+        self.default_max_ppi_ms = max_ppi_ms
+        self.reset()
+
+    def mean(self):
+        return self.mean_acc >> self.MEAN_SHIFT if self.mean_acc >= 0 else 0
+
+    def reset(self):
+        self.set_limits(self.default_min_ppi_ms, self.default_max_ppi_ms)
+        self.index = 0
+        self.mean_acc = -1 # average << MEAN_SHIFT, negative until the first sample
+        self.high = 0
+        self.low = 0
+        self.previous = 0
+        self.armed = False
+        self.last_beat = -1
+        self.weight = 0 # samples in the running average, until it turns into the decaying one
+        self.prior = False
+        self.gap_in_interval = False
+        self.corrected = 0 # intervals lengthened by lost samples
+        self.discarded = 0 # intervals dropped because of a long gap
+
+    def set_limits(self, min_ppi_ms, max_ppi_ms):
+        """narrow the accepted intervals, e.g. around a known heart rate. reset() restores the defaults,
+        and so do a few crossings in a row that only the narrowed limits reject"""
+        self.min_ppi_ms = min_ppi_ms
+        self.max_ppi_ms = max_ppi_ms
+        self.narrowed = min_ppi_ms != self.default_min_ppi_ms or max_ppi_ms != self.default_max_ppi_ms
+        self.misfits = 0
+        self.short_ppi = 0 # latest crossing since the last beat that came too soon for the narrowed limits
+
+    def prime(self, mean, high, low):
+        """start from the levels of an earlier session instead of from the first sample.
+        the prior is dropped if the first samples are far outside it"""
+        self.reset()
+        if high <= low:
+            return
+        self.mean_acc = mean << self.MEAN_SHIFT
+        self.high = self.prior_high = high
+        self.low = self.prior_low = low
+        self.seen_high = 0
+        self.seen_low = 0xFFFF
+        self.previous = mean
+        self.weight = self.PRIOR_WEIGHT
+        self.prior = True
+
+    def start(self, sample):
+        self.mean_acc = sample << self.MEAN_SHIFT
+        self.high = self.low = self.previous = sample
+        self.weight = 1
+        self.prior = False
+
+    def check_prior(self, sample):
+        """returns False if the sample does not fit the prior levels at all"""
+        span = self.prior_high - self.prior_low
+        if sample > self.prior_high + span or sample < self.prior_low - span:
+            return False
+
+        if sample > self.seen_high:
+            self.seen_high = sample
+        if sample < self.seen_low:
+            self.seen_low = sample
+
+        if self.weight == (1 << self.MEAN_SHIFT) - 1:
+            # a second in: a weaker signal than last time would keep the threshold too high, so
+            # narrow the envelopes down to what was actually seen
+            self.high = min(self.high, self.seen_high)
+            self.low = max(self.low, self.seen_low)
+            self.prior = False
+        return True
+
+    def feed(self, sample, gap = 0):
+        """process one sample. gap is the number of samples lost right before it.
+        returns the beat interval in ms when the sample completes one, otherwise 0"""
+        if gap:
+            self.skip(gap, sample)
+        index = self.index
+        self.index += 1
+
+        if self.mean_acc < 0 or (self.prior and not self.check_prior(sample)):
+            self.start(sample)
+            return 0
+
+        if self.weight < 1 << self.MEAN_SHIFT:
+            # plain running average until the first second is in, so the threshold is usable right away
+            self.weight += 1
+            self.mean_acc += ((sample << self.MEAN_SHIFT) - self.mean_acc) // self.weight
+        else:
+            self.mean_acc += sample - (self.mean_acc >> self.MEAN_SHIFT)
+        mean = self.mean_acc >> self.MEAN_SHIFT
+
+        if sample > self.high:
+            self.high = sample
+        else:
+            self.high -= (self.high - mean) >> self.ENVELOPE_SHIFT
+
+        if sample < self.low:
+            self.low = sample
+        else:
+            self.low += (mean - self.low) >> self.ENVELOPE_SHIFT
+
+        threshold = mean + (self.high - self.low) // 5
+        previous = self.previous
+        self.previous = sample
+
+        # only count a crossing after the signal has been below the average, so noise on the
+        # upstroke or a notch after the peak is not taken as a new beat
+        if sample < mean:
+            self.armed = True
+        if not self.armed or not previous <= threshold <= sample:
+            return 0
+        self.armed = False
+
+        if self.last_beat < 0:
+            self.last_beat = index
+            self.short_ppi = 0
+            self.gap_in_interval = False
+            return 0
+
+        ppi = (index - self.last_beat) * self.SAMPLE_INTERVAL_MS
+        if self.narrowed:
+            ppi = self.check_limits(ppi)
+        if ppi < self.min_ppi_ms:
+            return 0 # still the same upstroke
+
+        self.last_beat = index
+        self.short_ppi = 0
+        spans_gap = self.gap_in_interval
+        self.gap_in_interval = False
+        if ppi >= self.max_ppi_ms:
+            return 0
+        if spans_gap:
+            self.corrected += 1
+        return ppi
+
+    def check_limits(self, ppi):
+        """crossings only the narrowed limits reject are skipped like notches and missed beats, until they
+        show that the rhythm is not the one the limits were set for. returns the interval to go on with"""
+        if ppi < self.min_ppi_ms:
+            if ppi >= self.default_min_ppi_ms:
+                if self.short_ppi and ppi - self.short_ppi >= self.default_min_ppi_ms:
+                    self.misfits += 2 # another beat within a narrowed interval, not noise right after the last one
+                self.short_ppi = ppi
+        elif ppi >= self.max_ppi_ms:
+            if ppi < self.default_max_ppi_ms:
+                self.misfits += 2 # a missed beat or a slower rhythm
+        elif self.short_ppi and abs(2 * self.short_ppi - ppi) <= ppi >> 3:
+            # the short crossing split the interval in two even halves: not a notch, a beat of a rhythm
+            # twice as fast. the interval since that beat is the real one
+            ppi -= self.short_ppi
+            self.set_limits(self.default_min_ppi_ms, self.default_max_ppi_ms)
+            return ppi
+        elif self.misfits:
+            self.misfits -= 1 # fits, a notch before it is left alone
+
+        if self.misfits >= self.MAX_MISFITS:
+            self.set_limits(self.default_min_ppi_ms, self.default_max_ppi_ms)
+        return ppi
+
+    def skip(self, gap, sample):
+        """account for lost samples: the index keeps following wall time, so an interval over a short gap
+        is still right. after a long gap the interval is dropped and timing restarts from the next beat"""
+        self.index += gap
+        if gap > self.MAX_CORRECTED_GAP:
+            self.previous = sample # no crossing from the stale sample before the gap
+            if self.last_beat >= 0:
+                self.last_beat = -1
+                self.discarded += 1
+        elif self.last_beat >= 0:
+            self.gap_in_interval = True
+
+class PPIWindow:
+    """sliding window of the latest accepted beat intervals. keeps a running sum, so each beat is O(1)"""
+    def __init__(self, size = 5, tolerance_ms = 250, max_rejects = 3, tolerance_pct = 20):
+        self.size = size
+        self.tolerance_ms = tolerance_ms
+        self.tolerance_pct = tolerance_pct # relative tolerance, tighter than tolerance_ms at high heart rates
+        self.max_rejects = max_rejects # this many outliers in a row means the rhythm really changed
+        self.values = array('H', [0] * size)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.pos = 0
+        self.total = 0
+        self.rejects = 0
+        self.pending = 0 # first interval, waiting for a second one to agree with it
+
+    def agrees(self, ppi, reference):
+        return abs(ppi - reference) <= min(self.tolerance_ms, reference * self.tolerance_pct // 100)
+
+    def add(self, ppi):
+        """add an interval, returns False if it was rejected as an outlier or is waiting for a second one"""
+        if not self.count:
+            # the first interval after a start is often off, e.g. the detector's start-up interval.
+            # the window only starts once two intervals in a row agree
+            if not self.pending or not self.agrees(ppi, self.pending):
+                self.pending = ppi
+                return False
+            self.push(self.pending)
+            self.pending = 0
+        elif not self.agrees(ppi, self.mean()):
+            self.rejects += 1
+            if self.rejects <= self.max_rejects:
+                return False
+            # a run of outliers means the rhythm really changed, start over from this interval
+            self.reset()
+            self.pending = ppi
+            return False
+
+        self.rejects = 0
+        self.push(ppi)
+        return True
+
+    def push(self, ppi):
+        if self.count == self.size:
+            self.total -= self.values[self.pos]
+        else:
+            self.count += 1
+
+        self.values[self.pos] = ppi
+        self.total += ppi
+        self.pos = (self.pos + 1) % self.size
+
+    def mean(self):
+        return (self.total + self.count // 2) // self.count if self.count else 0
+
+    def bpm(self):
+        mean = self.mean()
+        return (60000 + mean // 2) // mean if mean else 0
+
+class SignalQuality:
+    """cheap running signal quality index (0-100). every beat is scored for clipping, amplitude,
+    a plausible interval and regularity, and the score decays while no beats are found.
+    regularity only counts for plausible intervals, noise crossings are regular only by accident"""
+    SAMPLE_INTERVAL_MS = analysis.SAMPLE_INTERVAL_MS
+    CLIP_HIGH = 65000 # read_u16 saturates at 65535
+    CLIP_LOW = 500
+    MIN_AMPLITUDE = 1000
+    NO_BEAT_MS = 2000 # decay the score after this long without a beat
+
+    def __init__(self, min_ppi_ms = 272, max_ppi_ms = analysis.PPI_THRESHOLD_MAX):
+        self.min_ppi_ms = min_ppi_ms
+        self.max_ppi_ms = max_ppi_ms
+        self.reset()
+
+    def reset(self):
+        self.score = 50 # neutral until the first beats are in
+        self.beats = 0
+        self.good_beats = 0
+        self.clipped = 0
+        self.since_beat = 0
+
+    def sample(self, sample):
+        if sample >= self.CLIP_HIGH or sample <= self.CLIP_LOW:
+            self.clipped += 1
+
+        self.since_beat += 1
+        if self.since_beat * self.SAMPLE_INTERVAL_MS >= self.NO_BEAT_MS and not self.since_beat % 250:
+            self.score -= self.score >> 2 # a quarter down every second without a beat
+
+    def beat(self, ppi, amplitude, reference_ppi):
+        """score one beat interval. reference_ppi is the running average before this beat, 0 if there is none"""
+        points = 0
+        if self.clipped * self.SAMPLE_INTERVAL_MS * 10 < ppi: # less than a tenth of the interval clipped
+            points += 20
+        if amplitude >= self.MIN_AMPLITUDE:
+            points += 20
+        if self.min_ppi_ms <= ppi <= self.max_ppi_ms:
+            points += 30
+            # within 25% of the running average
+            if not reference_ppi or abs(ppi - reference_ppi) * 4 <= reference_ppi:
+                points += 30
+
+        self.score += (points - self.score) >> 2 # running average over ~4 beats
+        self.beats += 1
+        if points == 100:
+            self.good_beats += 1
+
+        self.clipped = 0
+        self.since_beat = 0
+        return points
@@ -0,0 +1,163 @@
+import os
+import ujson
+
+class HistoryStore:
+    """bounded on-flash store for measurement results. keeps an in-memory index so saving does not rescan the directory"""
+    DEFAULT_MAX_ENTRIES = 200
+    DEFAULT_MAX_BYTES = 64 * 1024 # total size budget for the history directory
+    DEFAULT_MIN_FREE_BYTES = 32 * 1024 # always leave this much of the filesystem free
+
+    def __init__(self, directory = "history", max_entries = DEFAULT_MAX_ENTRIES, max_bytes = DEFAULT_MAX_BYTES, min_free_bytes = DEFAULT_MIN_FREE_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+
+        # index of stored entries, oldest first: [sequence number, size]. entries are numbered instead of named
+        # after the timestamp, the clock is not synced and restarts from the same time on every boot
+        self._index = None
+        self._total_bytes = 0
+        self._next_seq = 1
+
+    def _ensure_directory(self):
+        try:
+            os.stat(self.directory)
+        except OSError:
+            os.mkdir(self.directory)
+
+    def _load_index(self):
+        """build the index once from the directory listing"""
+        self._ensure_directory()
+        self._index = []
+        self._total_bytes = 0
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".tmp"):
+                self._remove_file(filename) # left over from a save that did not finish
+                continue
+            if not filename.endswith(".json"):
+                continue
+
+            try:
+                identifier = int(filename[:-5])
+                size = os.stat(f"{self.directory}/{filename}")[6]
+            except (ValueError, OSError):
+                continue # skip files not written by the store
+
+            self._index.append([identifier, size])
+            self._total_bytes += size
+
+        self._index.sort(key = lambda entry: entry[0])
+        # continue after the newest entry, so the numbers keep increasing across boots
+        self._next_seq = self._index[-1][0] + 1 if self._index else 1
+
+    def _remove_file(self, filename):
+        try:
+            os.remove(f"{self.directory}/{filename}")
+        except OSError as e:
+            print(f"Error removing {filename}: {e}")
+
+    def _index_ready(self):
+        if self._index is None:
+            self._load_index()
+        return self._index
+
+    def path(self, identifier):
+        return f"{self.directory}/{identifier}.json"
+
+    def entries(self):
+        """filenames of stored entries, newest first"""
+        return [f"{entry[0]}.json" for entry in reversed(self._index_ready())]
+
+    def count(self):
+        return len(self._index_ready())
+
+    def filesystem_stats(self):
+        """(block size, free bytes) of the filesystem, None if they cannot be read"""
+        try:
+            stat = os.statvfs(self.directory)
+            return stat[0], stat[0] * stat[4] # f_bsize, f_bsize * f_bavail
+        except OSError as e:
+            print(f"Error reading filesystem stats: {e}")
+            return None
+
+    def free_bytes(self):
+        """free filesystem space available to the history directory, None if it cannot be read"""
+        stats = self.filesystem_stats()
+        return stats[1] if stats else None
+
+    def _remove(self, position):
+        identifier, size = self._index.pop(position)
+        self._total_bytes -= size
+        self._remove_file(f"{identifier}.json")
+
+    def _plan_room(self, size):
+        """number of oldest entries to evict so a new entry of size bytes fits both the budget and the free
+        space, or None if it cannot fit. nothing is removed here, so a save that cannot fit loses nothing"""
+        stats = self.filesystem_stats()
+        if stats:
+            block_size, free = stats
+            # the filesystem rounds files up to whole blocks
+            on_disk = lambda n: (n + block_size - 1) // block_size * block_size
+        else:
+            free = None # unknown, only the budget is checked
+            print("Free space unknown, checking the history budget only")
+
+        count = len(self._index)
+        total = self._total_bytes
+
+        evict = 0
+        for _, entry_size in self._index:
+            if count < self.max_entries and total + size <= self.max_bytes and (free is None or free - on_disk(size) >= self.min_free_bytes):
+                return evict
+            evict += 1
+            count -= 1
+            total -= entry_size
+            if free is not None:
+                free += on_disk(entry_size)
+
+        if total + size <= self.max_bytes and (free is None or free - on_disk(size) >= self.min_free_bytes):
+            return evict
+        return None
+
+    def save(self, data):
+        """save data as a new entry. returns True if the entry was written"""
+        index = self._index_ready()
+        identifier = self._next_seq
+        temp_path = f"{self.directory}/{identifier}.tmp"
+
+        try:
+            payload = ujson.dumps(data)
+
+            evict = self._plan_room(len(payload))
+            if evict is None:
+                print("Not enough free space to save history entry")
+                return False
+
+            # written to a temporary file and renamed into place, so a failed or interrupted write never
+            # leaves a partial entry behind. every entry goes to its own freshly created file, so the
+            # filesystem spreads the writes over free blocks instead of rewriting the same ones
+            try:
+                with open(temp_path, "w") as f:
+                    f.write(payload)
+                os.rename(temp_path, self.path(identifier))
+            except OSError as e:
+                print(f"Error writing history entry: {e}")
+                self._remove_file(f"{identifier}.tmp")
+                return False
+
+            # only now that the new entry is safe, make room for it
+            for _ in range(evict):
+                evicted = index[0][0]
+                self._remove(0)
+                print(f"History budget reached, evicted entry {evicted}")
+
+            index.append([identifier, len(payload)])
+            self._total_bytes += len(payload)
+            self._next_seq = identifier + 1
+
+            print(f"Data saved to {self.path(identifier)}")
+            return True
+        except Exception as e:
+            print(f"Error saving data to JSON: {e}")
+            return False
@@ -9,9 +9,11 @@ from components.Display import Display
 from components.Sensor import SensorFifo
 
 from menu import Menu
-from measurement import LiveHRMeasurement, AnalysisMeasurement
+from measurement import LiveHRMeasurement, AnalysisMeasurement, StreamMeasurement
 from capture_history import History
-from network_handlers import NetworkHandler, MQTTHandler
+from history_store import HistoryStore
+from baseline import Baseline
+from network_handlers import NetworkHandler, MQTTHandler, ConnectionManager
 
 micropython.alloc_emergency_exception_buf(200)
 
@@ -35,27 +37,53 @@ WLAN = NetworkHandler(display, WLAN_SSID, WLAN_PASSWORD)
 MQTT = MQTTHandler(display, MQTT_BROKER_IP, MQTT_BROKER_PORT)
 wlan_connected = WLAN.connect()
 
+# history is shared between the measurements and the history view so the index is built only once
+HISTORY = HistoryStore("history", max_entries = 200)
+# signal levels and typical interval of the last good session, the beat detectors of the continuous live HR
+# and the HRV capture start from them
+BASELINE = Baseline("baseline.json")
+
+if wlan_connected: # initialize mqtt connection if wlan is connected
+    MQTT.connect()
+
+# keeps wlan & mqtt up in the background, reconnecting when the link drops
+CONNECTION = ConnectionManager(WLAN, MQTT)
+
 # initialize the menu
-menu_items = [
-    ("Instant HR", LiveHRMeasurement(display, switch, 1024).run),
-    ("HRV Analysis", AnalysisMeasurement(display, switch, 1024, with_kubios = False, mqtt_handler = MQTT).run),
-    ("History", History(display, switch, rot, "history").run),
+offline_items = [
+    ("Instant HR", LiveHRMeasurement(display, switch, 1024, baseline = BASELINE).run),
+    ("HRV Analysis", AnalysisMeasurement(display, switch, 1024, with_kubios = False, mqtt_handler = MQTT, history_store = HISTORY, baseline = BASELINE).run),
+    ("History", History(display, switch, rot, "history", store = HISTORY).run),
+]
+online_items = [
+    ("Kubios", AnalysisMeasurement(display, switch, 1024, with_kubios = True, mqtt_handler = MQTT, history_store = HISTORY, baseline = BASELINE).run),
+    ("Stream PPG", StreamMeasurement(display, switch, 1024, mqtt_handler = MQTT).run),
 ]
 
-if wlan_connected: # initialize mqtt connection & add kubios to menu if wlan is connected
-    MQTT.connect()
-    menu_items.insert(2, ("Kubios", AnalysisMeasurement(display, switch, 1024, with_kubios = True, mqtt_handler = MQTT).run))
+def menu_items(online):
+    """kubios & streaming are only shown while the mqtt connection is up"""
+    items = list(offline_items)
+    if online:
+        items[2:2] = online_items
+    return items
 
+items = menu_items(CONNECTION.is_online())
 menu = Menu(
     display = display,
-    options = [item[0] for item in menu_items],
-    actions = [item[1] for item in menu_items],
-    text_size = 16
+    options = [item[0] for item in items],
+    actions = [item[1] for item in items],
+    text_size = 11 # 5 items fit on the screen when online
 )
 menu.show()
 
 # main loop
 while True:
+    if CONNECTION.poll(): # went online or offline, add or remove kubios
+        items = menu_items(CONNECTION.is_online())
+        menu.set_items([item[0] for item in items], [item[1] for item in items])
+        display.clear()
+        menu.show()
+    
     if rot.fifo.has_data():
         delta = rot.fifo.get()
         menu.move_pointer(delta)
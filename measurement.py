@@ -2,10 +2,18 @@ from utils import average
 from piotimer import Piotimer
 from fifo import Fifo
 import time
-import math
+import gc
+import random
+from array import array
+
+import analysis
 
 from components.Sensor import SensorFifo
-from utils import wait_for_press, save_json, average, stddev, convert_iso_epoch
+from history_store import HistoryStore
+from baseline import Baseline
+from streaming import PPGStreamer
+from heartbeat import BeatDetector, PPIWindow, SignalQuality
+from utils import wait_for_press, average, stddev, convert_iso_epoch
 
 class BaseMeasurement:
     MIN_BPM = 30
@@ -20,30 +28,11 @@ class BaseMeasurement:
         self.fifo = SensorFifo(fifo_size)
         self.timer = Piotimer(mode = Piotimer.PERIODIC, period = 4, callback = self.fifo.handler)
     
-    def get_peaks(self, samples):
-        peaks = []
-        threshold = average(samples) + (max(samples) - min(samples)) / 5
-
-        for i in range(len(samples) - 1):
-            if samples[i] <= threshold <= samples[i + 1]:
-                peaks.append(i + 1)
-
-        return peaks
-
-    def get_ppi(self, peaks):    
-        # these might need some tweaking still
-        ppi_threshold_min = 150
-        ppi_threshold_max = 2000
-
-        output = []
-
-        for i in range(len(peaks) - 1):
-            ppi = (peaks[i + 1] - peaks[i]) * 4
-
-            if ppi_threshold_min < ppi < ppi_threshold_max:
-                output.append(ppi)
+    def get_peaks(self, samples, count = None):
+        return analysis.get_peaks(samples, count)
 
-        return output
+    def get_ppi(self, peaks):
+        return analysis.get_ppi(peaks)
 
 class LiveHRMeasurement(BaseMeasurement):
     """Measurement class for live heart rate measurement"""
@@ -52,6 +41,42 @@ class LiveHRMeasurement(BaseMeasurement):
     BPM_UPDATE_INTERVAL_MS = 5000
     DISPLAY_REFRESH_INTERVAL_MS = 500
     SAMPLE_SIZE = 1250 # 250Hz * 5s
+    PPI_WINDOW = 5 # beats averaged in continuous mode
+    MIN_WINDOW_PPI = 2 # first reading after 3 beats
+    BASELINE_MIN_BEATS = 20 # accepted beats before a session is good enough to save as the baseline
+    GRAPH_REFRESH_INTERVAL_MS = 25
+    GRAPH_X_SCALE = 2
+    
+    def __init__(self, *args, continuous = True, smoothing = PPI_WINDOW, baseline = None, **kwargs):
+        """continuous updates the bpm on every beat, otherwise it is recalculated from 5s windows.
+        smoothing is the number of beat intervals averaged for the continuous reading"""
+        super().__init__(*args, **kwargs)
+        self.continuous = continuous
+        self.detector = BeatDetector()
+        self.window = PPIWindow(smoothing, self.NORM_PPI_TOLERANCE_MS)
+        self.baseline = baseline if baseline else Baseline()
+        self.accepted = 0
+        self.rolling_window = array('H', [0] * (self.display.width // self.GRAPH_X_SCALE)) # ring buffer of the values on screen
+        self.samples = []
+        self.ppi = []
+        self.heart_rate = 0
+        
+    def track_beats(self):
+        """feed new samples to the beat detector, returns the latest sample or -1 if there was none"""
+        latest = -1
+        while self.fifo.has_data():
+            latest = self.fifo.get()
+            ppi = self.detector.feed(latest, self.fifo.last_gap)
+            if ppi and self.window.add(ppi):
+                self.accepted += 1
+        return latest
+    
+    def current_bpm(self):
+        if self.window.count < self.MIN_WINDOW_PPI:
+            return 0
+        
+        bpm = self.window.bpm()
+        return bpm if self.MIN_BPM <= bpm <= self.MAX_BPM else 0
 
     def collect_samples(self, samples):
         while self.fifo.has_data():
@@ -76,15 +101,17 @@ class LiveHRMeasurement(BaseMeasurement):
 
         if len(ppi) > self.MIN_PPI_COUNT:
             peak_avg = average(ppi)
-            norm_ppi = [
-                i for i in ppi
-                if (peak_avg - self.NORM_PPI_TOLERANCE_MS) < i < (peak_avg + self.NORM_PPI_TOLERANCE_MS)
-            ]
-            if norm_ppi:
-                avg_ppi = average(norm_ppi)
+            norm_total = norm_count = 0
+            for i in ppi:
+                if (peak_avg - self.NORM_PPI_TOLERANCE_MS) < i < (peak_avg + self.NORM_PPI_TOLERANCE_MS):
+                    norm_total += i
+                    norm_count += 1
+            if norm_count:
+                avg_ppi = round(norm_total / norm_count)
                 bpm = round(60000 / avg_ppi)
                 if self.MIN_BPM <= bpm <= self.MAX_BPM:
-                    return bpm, ppi[-5:]
+                    del ppi[:-5] # keep the latest intervals in place
+                    return bpm, ppi
 
         return 0, ppi
 
@@ -101,7 +128,7 @@ class LiveHRMeasurement(BaseMeasurement):
         self.display.centered_texts([
             "Final HR",
             " ",
-            f"{final_bpm} BPM" if ppi else "---",
+            f"{final_bpm} BPM" if final_bpm else "---",
             " ",
             "Press to exit",
         ])
@@ -109,15 +136,62 @@ class LiveHRMeasurement(BaseMeasurement):
         samples.clear()
         ppi.clear()
         
+    def start(self, now):
+        """reset the loop state, right before the first step"""
+        self.rolling_pos = -1 # -1 until the first value fills the window
+        self.shown_heart_rate = -1
+        self.last_bpm_update = self.last_display_refresh = self.last_graph_refresh = now
+        
+    def step(self, now):
+        """one pass of the measurement loop, returns False once the button is pressed.
+        in continuous mode it only allocates when the heading changes"""
+        if self.switch.single_press():
+            return False
+        
+        if self.continuous:
+            latest = self.track_beats()
+            self.heart_rate = self.current_bpm() or self.heart_rate
+        else:
+            self.collect_samples(self.samples)
+            latest = self.samples[-1] if self.samples else -1
+        
+        # draw the ppg
+        if time.ticks_diff(now, self.last_graph_refresh) > self.GRAPH_REFRESH_INTERVAL_MS and latest >= 0:
+            rolling_window = self.rolling_window
+            if self.rolling_pos < 0:
+                for i in range(len(rolling_window)):
+                    rolling_window[i] = latest
+            self.rolling_pos = (self.rolling_pos + 1) % len(rolling_window)
+            rolling_window[self.rolling_pos] = latest
+            
+            self.display.draw_ppg_graph(latest, min(rolling_window), max(rolling_window))
+            self.last_graph_refresh = now
+            
+        if not self.continuous and self.should_update_bpm(now, self.last_bpm_update, self.samples):
+            new_hr, self.ppi = self.update_bpm(self.samples, self.ppi)
+            if new_hr:
+                self.heart_rate = new_hr
+                self.last_bpm_update = now
+            gc.collect() # between windows
+        
+        # update heading text, the text is only formatted when the value changed
+        if time.ticks_diff(now, self.last_display_refresh) > self.DISPLAY_REFRESH_INTERVAL_MS:
+            if self.heart_rate != self.shown_heart_rate:
+                self.display.heading("HR", f"{self.heart_rate} BPM" if self.heart_rate else "---", clear_only_heading = True)
+                self.shown_heart_rate = self.heart_rate
+                gc.collect() # right after the display commit, the fifo has plenty of room
+            self.last_display_refresh = now
+        return True
+        
     def run(self):
-        ROLLING_WINDOW_SIZE = 100
-        GRAPH_REFRESH_INTERVAL_MS = 25
-        GRAPH_X_SCALE = 2
-        VISIBLE_GRAPH_WIDTH = self.display.width // GRAPH_X_SCALE
-        rolling_window = []
-        samples = []
-        ppi = []
-        heart_rate = 0
+        self.samples.clear()
+        self.ppi.clear()
+        self.heart_rate = 0
+        self.detector.reset()
+        self.window.reset()
+        self.accepted = 0
+        if self.continuous and self.baseline.prime(self.detector):
+            print("Beat detector primed from the baseline")
         
         self.fifo.recording = False
         self.fifo.reset()
@@ -127,83 +201,174 @@ class LiveHRMeasurement(BaseMeasurement):
         wait_for_press(self.switch)
         print("Live HR recording started")
 
-        last_bpm_update = last_display_refresh = time.ticks_ms()
-        last_graph_refresh = time.ticks_ms()
+        self.start(time.ticks_ms())
 
         try:
             self.display.clear()
-            while not self.switch.single_press():
-                self.collect_samples(samples)
-                
-                now = time.ticks_ms()
-                
-                # draw the ppg
-                if time.ticks_diff(now, last_graph_refresh) > GRAPH_REFRESH_INTERVAL_MS and samples:
-                    new_val = samples[-1]
-                    rolling_window.append(new_val)
-                    if len(rolling_window) > VISIBLE_GRAPH_WIDTH:
-                        rolling_window.pop(0)
-
-                    min_val = min(rolling_window)
-                    max_val = max(rolling_window)
-
-                    self.display.draw_ppg_graph(new_val, min_val, max_val)
-                    
-                if self.should_update_bpm(now, last_bpm_update, samples):
-                    new_hr, ppi = self.update_bpm(samples, ppi)
-                    if new_hr:
-                        heart_rate = new_hr
-                        last_bpm_update = now
-
-                # update heading text
-                if time.ticks_diff(now, last_display_refresh) > self.DISPLAY_REFRESH_INTERVAL_MS:
-                    self.display.heading("HR", f"{heart_rate} BPM" if heart_rate else "---", clear_only_heading = True)
-                    last_display_refresh = now
+            gc.collect() # start from a clean heap, the loop below only allocates when the heading changes
+            while self.step(time.ticks_ms()):
+                pass
 
         finally:
             self.fifo.recording = False
-            self.cleanup(samples, ppi, heart_rate)
+            if self.continuous:
+                print(f"{self.fifo.dc} samples lost, {self.detector.corrected} intervals corrected, {self.detector.discarded} discarded")
+            if self.continuous and self.accepted >= self.BASELINE_MIN_BEATS and self.window.count == self.window.size:
+                self.baseline.save(self.detector, self.window.mean())
+            self.cleanup(self.samples, self.ppi, self.heart_rate)
             print("Live HR recording stopped")
             
 class AnalysisMeasurement(BaseMeasurement):
     """More in-depth HRV analysis measurement"""
     DURATION_MS = 30000
-    SAMPLE_SIZE = 7500 # 250Hz * 30s
-    MIN_PPI_COUNT = 10
+    MAX_DURATION_MS = 45000 # the window is extended up to this if there are too few good beats
+    EXTENSION_MS = 5000
+    EARLY_ABORT_MS = 10000 # give up after this long if the signal quality stays poor and good beats are too few
+    SAMPLE_SIZE = 11250 # 250Hz * 45s
+    MIN_PPI_COUNT = analysis.MIN_HRV_PPI_COUNT
+    MIN_QUALITY = 50
+    FEEDBACK_REFRESH_INTERVAL_MS = 500
+    KUBIOS_TIMEOUT_MS = 20000
+    MAX_GAPS = 32 # sample losses recorded per capture
+    
+    _sample_buffer = None # shared by all instances, only one measurement runs at a time
     
-    def __init__(self, *args, with_kubios = False, mqtt_handler = None, **kwargs):
+    def __init__(self, *args, with_kubios = False, mqtt_handler = None, history_store = None, baseline = None, **kwargs):
         super().__init__(*args, **kwargs)
         self.with_kubios = with_kubios
         self.mqtt_handler = mqtt_handler
-        self.samples = []
+        
+        if AnalysisMeasurement._sample_buffer is None:
+            AnalysisMeasurement._sample_buffer = array('H', [0] * self.SAMPLE_SIZE)
+        self.samples = AnalysisMeasurement._sample_buffer
+        self.sample_count = 0
         self.ppi = []
+        self.aborted = False
+        
+        # where samples were lost during the capture: position in the sample buffer and number of samples
+        self.gap_pos = array('H', [0] * self.MAX_GAPS)
+        self.gap_len = array('H', [0] * self.MAX_GAPS)
+        self.gap_count = 0
+        self.corrected = 0
+        self.discarded = 0
+        
+        # beat tracking during the capture, only used for the live signal quality
+        self.detector = BeatDetector()
+        self.window = PPIWindow(5)
+        self.quality = SignalQuality(min_ppi_ms = 60000 // self.MAX_BPM, max_ppi_ms = 60000 // self.MIN_BPM)
         
-        # hard-coded history directory
+        # hard-coded history directory, unless a shared store is passed in
         self.history_dir = "history"
+        self.history = history_store if history_store else HistoryStore(self.history_dir)
+        self.baseline = baseline if baseline else Baseline()
     
-    def collect_samples(self):
-        self.samples.clear()
+    def track_quality(self, sample, gap):
+        self.quality.sample(sample)
+        ppi = self.detector.feed(sample, gap)
+        if ppi:
+            reference = self.window.mean()
+            self.window.add(ppi)
+            self.quality.beat(ppi, self.detector.high - self.detector.low, reference)
+            
+    def record_gap(self, length):
+        if self.gap_count == self.MAX_GAPS:
+            # out of slots, the capture is broken up anyway. add to the last gap so the lost time still counts
+            self.gap_len[-1] = min(self.gap_len[-1] + length, 0xFFFF)
+            return
+        self.gap_pos[self.gap_count] = self.sample_count
+        self.gap_len[self.gap_count] = min(length, 0xFFFF)
+        self.gap_count += 1
+    
+    def gaps(self):
+        return [(self.gap_pos[i], self.gap_len[i]) for i in range(self.gap_count)]
+            
+    def display_feedback(self, elapsed, duration):
+        self.display.centered_texts([
+            "Collecting data",
+            " ",
+            f"Quality {self.quality.score}%",
+            f"Beats {self.quality.beats}",
+            f"{(duration - elapsed) // 1000}s left",
+        ])
+        gc.collect() # the texts above are the only allocations in the capture loop
+    
+    def start_capture(self, now):
+        """reset the capture state, right before the first capture step"""
+        self.sample_count = 0
+        self.gap_count = 0
+        self.corrected = 0
+        self.discarded = 0
         self.ppi.clear()
-        start_time = time.ticks_ms()
+        self.aborted = False
+        self.detector.reset()
+        self.window.reset()
+        self.quality.reset()
+        if self.baseline.prime(self.detector):
+            print("Beat detector primed from the baseline")
+        self.duration = self.DURATION_MS
+        self.start_time = self.last_feedback = now
+    
+    def capture_step(self, now):
+        """one pass of the capture loop, returns False when the capture is over.
+        only the feedback refresh allocates"""
+        while self.fifo.has_data() and self.sample_count < self.SAMPLE_SIZE:
+            sample = self.fifo.get()
+            gap = self.fifo.last_gap
+            if gap:
+                self.record_gap(gap)
+            self.samples[self.sample_count] = sample
+            self.sample_count += 1
+            self.track_quality(sample, gap)
+        
+        elapsed = time.ticks_diff(now, self.start_time)
+        
+        # a dip later on does not throw away a capture that already has enough good beats
+        if (elapsed >= self.EARLY_ABORT_MS and self.quality.score < self.MIN_QUALITY and
+                self.quality.good_beats < self.MIN_PPI_COUNT):
+            print(f"Poor signal quality ({self.quality.score}), aborting")
+            self.aborted = True
+            return False
+        
+        if elapsed >= self.duration:
+            if self.quality.good_beats >= self.MIN_PPI_COUNT or self.duration >= self.MAX_DURATION_MS:
+                return False
+            self.duration = min(self.duration + self.EXTENSION_MS, self.MAX_DURATION_MS)
+            print(f"Only {self.quality.good_beats} good beats, extending to {self.duration} ms")
+        
+        if time.ticks_diff(now, self.last_feedback) > self.FEEDBACK_REFRESH_INTERVAL_MS:
+            self.display_feedback(elapsed, self.duration)
+            self.last_feedback = now
+
+        if self.switch.single_press():
+            print("Early stop requested")
+            return False
+        return True
+    
+    def collect_samples(self):
+        self.start_capture(time.ticks_ms())
         
         self.fifo.recording = False
         self.fifo.reset()
+        gc.collect()
         self.fifo.recording = True
 
         try:
-            while time.ticks_diff(time.ticks_ms(), start_time) < self.DURATION_MS:
-                if self.fifo.has_data():
-                    self.samples.append(self.fifo.get())
-
-                if self.switch.single_press():
-                    print("Early stop requested")
-                    break
+            while self.capture_step(time.ticks_ms()):
+                pass
+                
+            if self.aborted:
+                return
 
-            peaks = self.get_peaks(self.samples)
+            peaks = self.get_peaks(self.samples, self.sample_count)
             print(f"Detected {len(peaks)} peaks")
             
-            self.ppi = self.get_ppi(peaks)
+            # the buffer only holds the samples that made it through the fifo, so intervals over lost
+            # samples are corrected or dropped. the fixed limits keep the result reproducible by
+            # tools/batch_analyze.py, the baseline only warm-starts the live beat tracking
+            self.ppi, self.corrected, self.discarded = analysis.get_ppi_with_gaps(peaks, self.gaps())
             print(f"Extracted {len(self.ppi)} PPI values")
+            if self.gap_count:
+                print(f"{self.fifo.dc} samples lost in {self.gap_count} gaps: {self.corrected} intervals corrected, {self.discarded} discarded")
 
         except Exception as e:
             print(f"Error during data collection: {e}")
@@ -213,38 +378,20 @@ class AnalysisMeasurement(BaseMeasurement):
             print(f"Total PPI values collected: {len(self.ppi)}")
     
     def mean_ppi(self, ppi_list):
-        return int(round(sum(ppi_list) / len(ppi_list)))
-
-    def mean_ppi(self, ppi_list):
-        return int(round(sum(ppi_list) / len(ppi_list)))
+        return analysis.mean_ppi(ppi_list)
 
     def mean_hr(self, mean_ppi):
-        return int(round(60000 / mean_ppi))
+        return analysis.mean_hr(mean_ppi)
 
     def sdnn(self, ppi_list):
-        mu = sum(ppi_list) / len(ppi_list)
-        var = sum((x - mu) ** 2 for x in ppi_list) / (len(ppi_list) - 1)
-        return math.sqrt(var)
+        return analysis.sdnn(ppi_list)
 
     def rmssd(self, ppi_list):
-        diffs = [ppi_list[i + 1] - ppi_list[i] for i in range(len(ppi_list) - 1)]
-        capped_diffs = [min(abs(d), 250) for d in diffs]
-        mean_sq = sum(d ** 2 for d in capped_diffs) / len(capped_diffs)
-        return math.sqrt(mean_sq)
+        return analysis.rmssd(ppi_list)
     
     def calculate_hrv(self):
         """locally calculates wanted HRV parameters from ppi data"""
-        mean_ppi = self.mean_ppi(self.ppi)
-        mean_hr = self.mean_hr(mean_ppi)
-        sdnn = self.sdnn(self.ppi)
-        rmssd = self.rmssd(self.ppi)
-        
-        return {
-            "mean_ppi": mean_ppi,
-            "mean_hr": mean_hr,
-            "sdnn": sdnn,
-            "rmssd": rmssd,
-        }
+        return analysis.calculate_hrv(self.ppi)
             
     def parse_cubios_data(self, data):
         analysis = data["data"]["analysis"]
@@ -282,7 +429,7 @@ class AnalysisMeasurement(BaseMeasurement):
 
         try:
             self.collect_samples()
-            print(len(self.samples))
+            print(self.sample_count)
         except Exception as e:
             print(f"Error during measurement: {e}")
             self.display.centered_texts([
@@ -290,7 +437,14 @@ class AnalysisMeasurement(BaseMeasurement):
                 "Press to exit",
             ])
 
-        if len(self.ppi) < self.MIN_PPI_COUNT:
+        if self.aborted:
+            self.display.centered_texts([
+                " ", "Poor signal.",
+                "Adjust finger",
+                "and try again", " ",
+                "Press to exit",
+            ])
+        elif len(self.ppi) < self.MIN_PPI_COUNT:
             print(f"Not enough data. PPI length: {len(self.ppi)}")
             self.display.centered_texts([
                 " ", "Not enough data.", " ",
@@ -319,16 +473,29 @@ class AnalysisMeasurement(BaseMeasurement):
                         "Kubios response",
                     ])
                     
-                    self.mqtt_handler.publish(
+                    self.mqtt_handler.reset_last_message()
+                    # publish checks the connection first and reconnects if it timed out during the capture
+                    sent = self.mqtt_handler.publish(
                         topic = "kubios-request",
                         data = kubios_payload
                     )
+                    if not sent:
+                        raise Exception("Kubios request could not be sent")
                     
+                    request_time = time.ticks_ms()
                     while self.mqtt_handler.get_last_message() == None:
+                        # give up if the link drops or the response never comes, instead of waiting forever
+                        if not self.mqtt_handler.is_connected:
+                            raise Exception("MQTT connection lost while waiting for Kubios")
+                        if time.ticks_diff(time.ticks_ms(), request_time) > self.KUBIOS_TIMEOUT_MS:
+                            raise Exception("Kubios response timed out")
+                        if self.switch.single_press():
+                            raise Exception("Kubios wait cancelled")
+                        
                         self.mqtt_handler.listen()
-                        mqtt_data = self.mqtt_handler.get_last_message()
                         time.sleep_ms(25)
                     
+                    mqtt_data = self.mqtt_handler.get_last_message()
                     self.mqtt_handler.reset_last_message()
                     
                     data = self.parse_cubios_data(mqtt_data)
@@ -355,17 +522,38 @@ class AnalysisMeasurement(BaseMeasurement):
                 
                 values_to_display = ["mean_ppi", "mean_hr", "sdnn", "rmssd", "sns", "pns"]
                 
+                if self.corrected or self.discarded:
+                    # the results screen is full, so the sample loss gets its own
+                    self.display.centered_texts([
+                        "Samples lost", " ",
+                        f"{self.corrected} PPI corrected",
+                        f"{self.discarded} PPI dropped",
+                        "Press for result",
+                    ])
+                    wait_for_press(self.switch)
+                
                 # display the values
                 self.display.texts(
                     [f"{key.upper().replace('_', ' ')}: {value}" for key, value in data.items() if key in values_to_display]   
                 )
                     
                 # save data to json
-                save_json(self.history_dir, data)
+                if not self.history.save(data):
+                    print("Measurement was not saved to history")
+                    wait_for_press(self.switch)
+                    self.display.centered_texts([
+                        " ", "Result not saved", "to history", " ",
+                        "Press to exit",
+                    ])
                 print(timestamp)
-                # publish to MQTT if handler is present
+                if self.quality.score >= self.MIN_QUALITY:
+                    self.baseline.save(self.detector, analysis.mean_ppi(self.ppi))
+                # publish to MQTT if handler is present. the device id is only needed by the collector,
+                # so it is not saved to the history
                 if self.mqtt_handler.is_connected:
-                    self.mqtt_handler.publish("hr-data", data)
+                    payload = dict(data)
+                    payload["device"] = self.mqtt_handler.device_id
+                    self.mqtt_handler.publish("hr-data", payload)
             except Exception as e:
                 print(f"Error during HRV analysis: {e}")
                 self.display.centered_texts([
@@ -373,4 +561,85 @@ class AnalysisMeasurement(BaseMeasurement):
                     "Press to exit",
                 ])
 
-        wait_for_press(self.switch)
\ No newline at end of file
+        wait_for_press(self.switch)
+        
+class StreamMeasurement(BaseMeasurement):
+    """streams the raw 250Hz ppg signal over mqtt for remote analysis"""
+    STATUS_REFRESH_INTERVAL_MS = 1000
+    
+    def __init__(self, *args, mqtt_handler = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mqtt_handler = mqtt_handler
+        self.streamer = PPGStreamer(mqtt_handler)
+        
+    def display_status(self):
+        self.display.centered_texts([
+            "PPG stream",
+            " ",
+            f"Sent {self.streamer.sent}",
+            f"Dropped {self.streamer.dropped}",
+            "Press to stop",
+        ])
+        gc.collect() # after the display commit, adding samples to the stream never allocates
+        
+    def step(self, now):
+        """one pass of the streaming loop, returns False when the stream stopped or the button is pressed.
+        only the status refresh allocates"""
+        if not self.streamer.active or self.switch.single_press():
+            return False
+        
+        # the timer keeps sampling into the fifo while a publish blocks, drain it first
+        while self.fifo.has_data():
+            sample = self.fifo.get()
+            self.streamer.add(sample, self.fifo.last_gap)
+            
+        self.streamer.service()
+        
+        if time.ticks_diff(now, self.last_status) > self.STATUS_REFRESH_INTERVAL_MS:
+            self.display_status()
+            self.last_status = now
+        return True
+        
+    def run(self):
+        self.display.centered_texts([
+            "PPG stream", " ",
+            "Place a finger",
+            "and press to",
+            "start streaming",
+        ])
+        wait_for_press(self.switch)
+        
+        if not self.mqtt_handler or not self.mqtt_handler.is_connected:
+            self.display.centered_texts([" ", "MQTT offline", " ", "Press to exit"])
+            wait_for_press(self.switch)
+            return
+        
+        # random, the clock is not synced and restarts from the same time on every boot
+        session = random.getrandbits(16)
+        self.streamer.start(session)
+        print(f"PPG stream {session} started")
+        
+        self.fifo.recording = False
+        self.fifo.reset()
+        self.fifo.recording = True
+        
+        self.last_status = time.ticks_ms()
+        self.display_status()
+        
+        try:
+            while self.step(time.ticks_ms()):
+                pass
+        finally:
+            self.fifo.recording = False
+            self.streamer.close()
+            print(f"PPG stream {session} stopped: {self.streamer.sent} chunks sent, {self.streamer.dropped} dropped")
+            if self.fifo.dc:
+                print(f"{self.fifo.dc} samples lost before streaming, reported in the chunk headers")
+        
+        self.display.centered_texts([
+            "Stream ended", " ",
+            f"Sent {self.streamer.sent}",
+            f"Dropped {self.streamer.dropped}",
+            "Press to exit",
+        ])
+        wait_for_press(self.switch)
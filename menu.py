@@ -10,6 +10,12 @@ class Menu:
     def show(self, clear = True):
         self.display.menu(self.options, self.pointer, self.start_y, self.text_size, clear)
         
+    def set_items(self, options, actions):
+        """replace the menu items, keeping the pointer inside the new list"""
+        self.options = options
+        self.actions = actions
+        self.move_pointer(0)
+        
     def move_pointer(self, delta):
         self.pointer = max(0, min(self.pointer + delta, len(self.options) - 1))
         
@@ -1,9 +1,13 @@
 import network
 import time
 import machine
+import random
 import ujson
+import ubinascii
 from umqtt.simple import MQTTClient
 
+import codec
+
 class NetworkHandler:
     """handler class for network"""
     def __init__(self, display, ssid, password):
@@ -11,9 +15,10 @@ class NetworkHandler:
         self.PASSWORD = password
         self.attempt = 0
         self.display = display
+        self.wlan = network.WLAN(network.STA_IF)
         
     def connect(self):
-        wlan = network.WLAN(network.STA_IF)
+        wlan = self.wlan
         wlan.active(True)
         wlan.connect(self.SSID, self.PASSWORD)
         
@@ -41,67 +46,282 @@ class NetworkHandler:
         time.sleep(3)
 
         return wlan.isconnected()
+    
+    def begin(self):
+        """start connecting without waiting for the result, poll isconnected() afterwards"""
+        self.wlan.active(True)
+        self.wlan.connect(self.SSID, self.PASSWORD)
+        
+    def isconnected(self):
+        return self.wlan.isconnected()
 
 class MQTTHandler:
+    KEEPALIVE_S = 60
+    CONNECT_TIMEOUT_S = 3 # bounds the tcp connect and the connack wait, poll() runs the connect from the menu loop
+    
     def __init__(self, display, broker_ip, broker_port):
         self.BROKER_IP = broker_ip
         self.BROKER_PORT = broker_port
-        self.client_id = "pico_w_client"
-        self.mqtt_topics_pub = ("kubios-request", "hr-data")
+        # every unit needs its own client id, the broker drops a client when another one connects with the same id
+        self.device_id = ubinascii.hexlify(machine.unique_id()).decode()
+        self.client_id = f"pico_w_{self.device_id}"
+        # the raw stream goes to a topic of its own per unit, so streams of different units never mix
+        self.stream_topic = f"ppg-stream/{self.device_id}"
+        self.mqtt_topics_pub = ("kubios-request", "hr-data", self.stream_topic)
         self.mqtt_topics_sub = "kubios-response"
         self.display = display
         self.is_connected = False
         self.client = None
         self.last_message = None
+        self.last_activity = time.ticks_ms() # last packet sent to the broker, which keeps the connection alive
         
-    def connect(self):
-        self.display.centered_texts([" ", "Connecting MQTT"])
+        # topics published in the compact binary format. filled from the bridge's retained caps message,
+        # so nothing is sent compact unless something on the broker can decode it
+        self.compact_topics = ()
+        
+    def connect(self, show_status = True):
+        if show_status:
+            self.display.centered_texts([" ", "Connecting MQTT"])
         
         try:
-            self.client = MQTTClient(self.client_id, self.BROKER_IP, self.BROKER_PORT)
+            self.client = MQTTClient(self.client_id, self.BROKER_IP, self.BROKER_PORT, keepalive = self.KEEPALIVE_S)
             self.client.set_callback(self.on_sub_message)
-            self.client.connect(clean_session = True)
+            try:
+                self.client.connect(clean_session = True, timeout = self.CONNECT_TIMEOUT_S)
+            except TypeError:
+                # umqtt.simple from before the timeout argument, the connect can block until lwip gives up
+                print("umqtt.simple without connect timeout, update the library")
+                self.client.connect(clean_session = True)
             self.client.subscribe(self.mqtt_topics_sub)
+            self.client.subscribe(codec.CAPS_TOPIC)
+            self.client.check_msg() # pick up the retained caps message if it is already here
             
             print("Connected to MQTT broker")
             
             self.is_connected = True
+            self.last_activity = time.ticks_ms()
             
         except Exception as e:
             print(f"Error occurred when connecting to MQTT broker: {e}")
             self.is_connected = False
         finally:
             return self.is_connected
+    
+    def connection_lost(self, error = None):
+        """drop the dead socket, the connection manager reconnects later"""
+        if self.is_connected:
+            print(f"MQTT connection lost: {error}")
+        self.is_connected = False
+        
+        if self.client:
+            try:
+                self.client.sock.close()
+            except Exception:
+                pass
+            self.client = None
+            
+    def set_timeout(self, seconds):
+        """socket timeout for the following publishes, None blocks. check_msg() resets it to None"""
+        if self.client:
+            self.client.sock.settimeout(seconds)
+    
+    def ping(self):
+        if not self.is_connected:
+            return False
+        
+        try:
+            self.client.ping()
+            self.client.check_msg() # consume the ping response
+            self.last_activity = time.ticks_ms()
+            return True
+        except OSError as e:
+            self.connection_lost(e)
+            return False
+       
+    def ensure_alive(self):
+        """make sure the connection still works before a publish. the connection manager only pings from the
+        menu, so after a long measurement the broker may already have dropped the client: ping if the link has
+        been idle, and reconnect once if it is gone. returns True if the connection is up"""
+        if self.is_connected and time.ticks_diff(time.ticks_ms(), self.last_activity) >= self.KEEPALIVE_S * 1000 // 2:
+            self.ping()
+        
+        if not self.is_connected:
+            print("MQTT connection down, reconnecting before publishing")
+            self.connect(show_status = False)
+        return self.is_connected
        
     def on_sub_message(self, topic, message):
         print(f"Recieved MQTT message on topic: {topic}")
         print(f"Message: {message}")
         
+        if topic == codec.CAPS_TOPIC.encode():
+            self.negotiate(message)
+            return
+        
         try:
             self.last_message = ujson.loads(message)
         except ValueError:
             print("Failed to decode JSON.")
             self.last_message = message
         
-    def publish(self, topic, data):
+    def negotiate(self, message):
+        """enable the compact format for the topics the bridge announced it can decode"""
+        try:
+            caps = ujson.loads(message)
+        except ValueError:
+            print("Failed to decode codec caps.")
+            return
+        
+        if caps.get("version") != codec.VERSION:
+            print(f"Unsupported codec version {caps.get('version')}, using JSON")
+            self.compact_topics = ()
+            return
+        
+        self.compact_topics = tuple(topic for topic in caps.get("topics", ()) if topic in codec.ENCODERS)
+        print(f"Compact MQTT payloads enabled for: {self.compact_topics}")
+        
+    def publish(self, topic, data, retry = True):
+        """publish data to a topic. returns False if the connection dropped.
+        with retry the connection is checked first and a failed publish is retried once after reconnecting"""
+        if retry and not self.ensure_alive():
+            return False
+        
         if self.client is None:
             raise Exception("No client to publish mqtt messages to.")
         
         if topic not in self.mqtt_topics_pub:
-            raise Exception(f"Invalid MQTT topic. Please use one of the following:\n {self.mqtt_topics}")
+            raise Exception(f"Invalid MQTT topic. Please use one of the following:\n {self.mqtt_topics_pub}")
         
         if isinstance(data, dict):
-            data = ujson.dumps(data)
+            if topic in self.compact_topics:
+                try:
+                    data, topic = codec.ENCODERS[topic](data), codec.compact_topic(topic)
+                except Exception as e: # a value that does not fit the record, fall back to json
+                    print(f"Compact encoding failed, sending JSON: {e}")
+            
+            if isinstance(data, dict):
+                data = ujson.dumps(data)
+        
+        try:
+            self.client.publish(topic, data)
+            self.last_activity = time.ticks_ms()
+            return True
+        except OSError as e:
+            self.connection_lost(e)
         
-        self.client.publish(topic, data)
+        if retry and self.connect(show_status = False):
+            try:
+                self.client.publish(topic, data)
+                self.last_activity = time.ticks_ms()
+                return True
+            except OSError as e:
+                self.connection_lost(e)
+        return False
         
     def listen(self):
         if self.client:
-            self.client.check_msg()
+            try:
+                self.client.check_msg()
+            except OSError as e:
+                self.connection_lost(e)
     
     def get_last_message(self):
         return self.last_message
 
     def reset_last_message(self):
         self.last_message = None
+
+class ConnectionManager:
+    """state machine that keeps WLAN and MQTT connected. poll() is called from the main menu loop, never from the
+    measurement loops. the WLAN steps never block, an MQTT connect attempt blocks for at most
+    MQTTHandler.CONNECT_TIMEOUT_S (with a umqtt.simple that supports the timeout)"""
+    OFFLINE = 0
+    WLAN_CONNECTING = 1
+    WLAN_UP = 2
+    ONLINE = 3
+    
+    WLAN_TIMEOUT_MS = 15000
+    BACKOFF_BASE_MS = 2000
+    BACKOFF_MAX_MS = 120000
+    PING_INTERVAL_MS = MQTTHandler.KEEPALIVE_S * 1000 // 2
+    
+    def __init__(self, network_handler, mqtt_handler):
+        self.network = network_handler
+        self.mqtt = mqtt_handler
+        self.attempt = 0
         
+        now = time.ticks_ms()
+        self.next_attempt = now
+        self.deadline = now
+        self.last_ping = now
+        
+        if mqtt_handler.is_connected:
+            self.state = self.ONLINE
+        elif network_handler.isconnected():
+            self.state = self.WLAN_UP
+        else:
+            self.state = self.OFFLINE
+            self.schedule_retry(now)
+            
+    def is_online(self):
+        return self.state == self.ONLINE
+    
+    def schedule_retry(self, now):
+        """exponential backoff with jitter, so a room full of devices does not reconnect in lockstep"""
+        delay = min(self.BACKOFF_BASE_MS << self.attempt, self.BACKOFF_MAX_MS)
+        delay += random.randint(0, delay // 2)
+        self.attempt = min(self.attempt + 1, 10)
+        self.next_attempt = time.ticks_add(now, delay)
+        
+    def poll(self):
+        """advance the state machine by one step. returns True when the device went online or offline"""
+        was_online = self.is_online()
+        now = time.ticks_ms()
+        wlan_up = self.network.isconnected()
+        
+        if self.state == self.OFFLINE:
+            if wlan_up:
+                self.state = self.WLAN_UP
+            elif time.ticks_diff(now, self.next_attempt) >= 0:
+                self.network.begin()
+                self.state = self.WLAN_CONNECTING
+                self.deadline = time.ticks_add(now, self.WLAN_TIMEOUT_MS)
+                
+        elif self.state == self.WLAN_CONNECTING:
+            if wlan_up:
+                print("Connected to WLAN")
+                self.state = self.WLAN_UP
+                self.attempt = 0
+                self.next_attempt = now
+            elif time.ticks_diff(now, self.deadline) >= 0:
+                print("WLAN connection failed, retrying later")
+                self.state = self.OFFLINE
+                self.schedule_retry(now)
+                
+        elif self.state == self.WLAN_UP:
+            if not wlan_up:
+                self.state = self.OFFLINE
+                self.next_attempt = now
+            elif time.ticks_diff(now, self.next_attempt) >= 0:
+                # connecting also re-subscribes to kubios-response
+                if self.mqtt.connect(show_status = False):
+                    self.state = self.ONLINE
+                    self.attempt = 0
+                    self.last_ping = now
+                else:
+                    self.schedule_retry(now)
+                    
+        elif self.state == self.ONLINE:
+            if not wlan_up:
+                print("WLAN link lost")
+                self.mqtt.connection_lost()
+                self.state = self.OFFLINE
+                self.next_attempt = now
+            elif not self.mqtt.is_connected:
+                self.state = self.WLAN_UP
+                self.schedule_retry(now)
+            elif time.ticks_diff(now, self.last_ping) >= self.PING_INTERVAL_MS:
+                self.mqtt.ping()
+                self.last_ping = now
+                
+        return was_online != self.is_online()
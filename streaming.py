@@ -0,0 +1,131 @@
+import time
+from array import array
+
+import codec
+
+class PPGStreamer:
+    """packs raw ppg samples into sequence-numbered chunks and publishes them over mqtt.
+    all chunk buffers are allocated up front, adding a sample never allocates"""
+    TOPIC = "ppg-stream" # published as ppg-stream/<device id>
+    CHUNK_SAMPLES = 125 # 0.5s of 250Hz samples per message
+    POOL_SIZE = 6
+    PUBLISH_TIMEOUT_S = 1 # a stalled publish gives up long before the 1024 sample sensor fifo overflows
+
+    def __init__(self, mqtt_handler, chunk_samples = CHUNK_SAMPLES, pool_size = POOL_SIZE):
+        self.mqtt_handler = mqtt_handler
+        self.topic = mqtt_handler.stream_topic
+        self.chunk_samples = chunk_samples
+        self.pool_size = pool_size
+        self.pool = [bytearray(codec.STREAM_HEADER_SIZE + chunk_samples * 2) for _ in range(pool_size)]
+        self.lengths = array('H', [0] * pool_size)
+        self.reset()
+
+    def reset(self, session = 0):
+        self.session = session
+        self.seq = 0
+        self.fill = 0 # buffer being filled
+        self.send = 0 # oldest buffer waiting to be published
+        self.queued = 0
+        self.count = 0 # samples in the buffer being filled
+        self.sent = 0
+        self.dropped = 0 # chunks dropped because the link could not keep up
+        self.lost = 0 # samples lost on the device since the last sent chunk header
+        self.lost_at = 0
+        self.active = True
+
+    def start(self, session):
+        """begin a new session. publishes time out instead of blocking the sampling loop"""
+        self.reset(session)
+        self.mqtt_handler.set_timeout(self.PUBLISH_TIMEOUT_S)
+
+    def add(self, sample, gap = 0):
+        """append one sample to the current chunk. gap is the number of samples lost right before it"""
+        if not self.active:
+            return
+
+        if gap:
+            if not self.lost:
+                self.lost_at = self.count
+            self.lost += gap
+
+        buf = self.pool[self.fill]
+        offset = codec.STREAM_HEADER_SIZE + self.count * 2
+        buf[offset] = sample & 0xFF
+        buf[offset + 1] = sample >> 8
+        self.count += 1
+
+        if self.count == self.chunk_samples:
+            self.finish_chunk()
+
+    def finish_chunk(self, flags = 0):
+        buf = self.pool[self.fill]
+        codec.pack_stream_header(buf, self.session, self.seq, self.count, flags, self.lost, self.lost_at)
+        self.lengths[self.fill] = codec.STREAM_HEADER_SIZE + self.count * 2
+        self.seq += 1
+        self.count = 0
+
+        if self.queued == self.pool_size - 1:
+            # no free buffer left to keep filling: drop this chunk and reuse its buffer.
+            # the sequence number was still consumed, so the receiver sees the gap. samples lost on the
+            # device in this chunk are reported at the start of the next one, right after the gap
+            self.dropped += 1
+            self.lost_at = 0
+            return
+
+        self.lost = 0
+        self.lost_at = 0
+
+        self.queued += 1
+        self.fill = (self.fill + 1) % self.pool_size
+
+    def service(self):
+        """publish at most one queued chunk, so the caller gets back to draining the sensor fifo quickly"""
+        if not self.queued:
+            return True
+
+        if not self.mqtt_handler.is_connected:
+            self.stop()
+            return False
+
+        buf = self.pool[self.send]
+        length = self.lengths[self.send]
+        # no reconnect in the middle of a stream, the samples would pile up in the fifo meanwhile
+        if length == len(buf):
+            sent = self.mqtt_handler.publish(self.topic, buf, retry = False)
+        else:
+            sent = self.mqtt_handler.publish(self.topic, memoryview(buf)[:length], retry = False)
+
+        if not sent:
+            self.stop()
+            return False
+
+        self.send = (self.send + 1) % self.pool_size
+        self.queued -= 1
+        self.sent += 1
+        return True
+
+    def stop(self):
+        """stop streaming cleanly, whatever is still queued is counted as dropped"""
+        if self.active:
+            print(f"PPG stream stopped, {self.queued} chunks not sent")
+        self.dropped += self.queued
+        self.queued = 0
+        self.active = False
+        self.mqtt_handler.set_timeout(None)
+
+    def close(self, timeout_ms = 2000):
+        """flush the partial chunk with the end flag and publish everything still queued"""
+        if not self.active:
+            return
+
+        # finish_chunk drops the chunk when no buffer is free, make room so the end flag gets out
+        while self.queued == self.pool_size - 1:
+            if not self.service():
+                return
+        self.finish_chunk(codec.STREAM_END)
+        start = time.ticks_ms()
+        while self.queued and time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            if not self.service():
+                break
+
+        self.stop()
@@ -0,0 +1,182 @@
+"""offline batch analysis of recorded ppg files
+
+runs the same analysis code as AnalysisMeasurement (analysis.get_peaks, get_ppi and calculate_hrv) on every
+recording in a directory, in parallel over a process pool. results are streamed to a csv or json lines file
+as they come in, so a long run can be followed and interrupted.
+
+supported recordings:
+    *.txt, *.csv    one sample per line, the filefifo format (also written by tools/ppg_receiver.py)
+    *.bin, *.raw    raw little-endian uint16 samples
+
+samples lost from a streamed recording are read from the "<session>.gaps.json" that tools/ppg_receiver.py
+writes next to it. intervals over a lost chunk are dropped, the counts are in the results
+
+run from the repository root:
+    python -m tools.batch_analyze recordings --out results.csv
+
+the analysis runs on numpy when it is installed, --backend python forces the plain python reference
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from array import array
+from multiprocessing import Pool
+
+import analysis
+
+TEXT_EXTENSIONS = (".txt", ".csv")
+BINARY_EXTENSIONS = (".bin", ".raw")
+
+FIELDS = (
+    "file", "status", "samples", "lost_samples", "peaks", "ppi_count", "corrected", "discarded",
+    "mean_ppi", "mean_hr", "sdnn", "rmssd", "error",
+)
+
+def read_recording(path):
+    """load a recording as an array of samples"""
+    if path.lower().endswith(BINARY_EXTENSIONS):
+        samples = array("H")
+        with open(path, "rb") as f:
+            data = f.read()
+        samples.frombytes(data[:len(data) - len(data) % 2])
+        if sys.byteorder != "little":
+            samples.byteswap()
+        return samples
+
+    samples = array("H")
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                samples.append(int(float(line)))
+    return samples
+
+def read_gaps(path):
+    """(position, length) sample gaps of a recording from its .gaps.json, empty if there is none"""
+    gaps_path = os.path.splitext(path)[0] + ".gaps.json"
+    if not os.path.exists(gaps_path):
+        return []
+
+    with open(gaps_path) as f:
+        info = json.load(f)
+    # files from before the device reported lost samples only have whole missing chunks
+    return [(gap["sample_index"], gap.get("samples", gap["chunks"] * info["chunk_samples"])) for gap in info["gaps"]]
+
+def analyze_file(path):
+    """run the on-device analysis on one recording, returns a result row"""
+    row = dict.fromkeys(FIELDS, "")
+    row["file"] = path
+
+    try:
+        samples = read_recording(path)
+        gaps = read_gaps(path)
+        peaks = analysis.get_peaks(samples)
+        ppi, corrected, discarded = analysis.get_ppi_with_gaps(peaks, gaps)
+
+        row.update(
+            samples = len(samples), lost_samples = sum(length for _, length in gaps), peaks = len(peaks),
+            ppi_count = len(ppi), corrected = corrected, discarded = discarded,
+        )
+
+        if len(ppi) < analysis.MIN_HRV_PPI_COUNT:
+            row["status"] = "not enough data"
+            return row
+
+        # rounded like the results saved on the device
+        hrv = analysis.calculate_hrv(ppi)
+        row.update({key: round(value) for key, value in hrv.items()})
+        row["status"] = "ok"
+    except Exception as e: # one broken file must not stop the batch
+        row["status"] = "error"
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    return row
+
+def init_worker(backend):
+    analysis.set_backend(backend)
+
+def find_recordings(directory, recursive = False):
+    extensions = TEXT_EXTENSIONS + BINARY_EXTENSIONS
+    paths = []
+
+    for root, dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(extensions))
+        if not recursive:
+            break
+
+    return sorted(paths)
+
+class ResultWriter:
+    """streams rows to csv or json lines, picked from the output file extension"""
+    def __init__(self, path):
+        self.file = open(path, "w", newline = "") if path != "-" else sys.stdout
+        self.json = path.endswith((".json", ".jsonl"))
+        if not self.json:
+            self.csv = csv.DictWriter(self.file, fieldnames = FIELDS)
+            self.csv.writeheader()
+
+    def write(self, row):
+        if self.json:
+            self.file.write(json.dumps(row) + "\n")
+        else:
+            self.csv.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+def progress(done, total, started, failed):
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed > 0 else 0
+    eta = (total - done) / rate if rate else 0
+    sys.stderr.write(f"\r{done}/{total} files, {failed} without result, {rate:.1f} files/s, eta {eta:.0f}s ")
+    sys.stderr.flush()
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Re-run the HRV analysis on recorded PPG files")
+    parser.add_argument("directory")
+    parser.add_argument("--out", default = "-", help = "results file, .csv or .jsonl (default: csv to stdout)")
+    parser.add_argument("--workers", type = int, default = os.cpu_count(), help = "processes in the pool")
+    parser.add_argument("--recursive", action = "store_true")
+    parser.add_argument("--backend", default = "auto", help = "analysis backend: auto, python or numpy")
+    args = parser.parse_args(argv)
+
+    try:
+        analysis.set_backend(args.backend)
+    except ValueError as e:
+        print(e, file = sys.stderr)
+        return 1
+
+    paths = find_recordings(args.directory, args.recursive)
+    if not paths:
+        print(f"No recordings found in {args.directory}", file = sys.stderr)
+        return 1
+    print(f"Analysing {len(paths)} recordings with the {analysis.backend_name()} backend", file = sys.stderr)
+
+    writer = ResultWriter(args.out)
+    started = last_progress = time.monotonic()
+    failed = 0
+    # big enough chunks to keep the workers busy, small enough for a smooth progress display
+    chunksize = max(1, min(32, len(paths) // (args.workers * 8)))
+
+    try:
+        with Pool(args.workers, init_worker, (args.backend,)) as pool:
+            for done, row in enumerate(pool.imap_unordered(analyze_file, paths, chunksize), 1):
+                writer.write(row)
+                if row["status"] != "ok":
+                    failed += 1
+                if done == len(paths) or time.monotonic() - last_progress >= 0.25:
+                    progress(done, len(paths), started, failed)
+                    last_progress = time.monotonic()
+    finally:
+        writer.close()
+        sys.stderr.write("\n")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
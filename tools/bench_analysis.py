@@ -0,0 +1,99 @@
+"""benchmark for the analysis backends
+
+times get_peaks, get_ppi and calculate_hrv on every available backend (or the one picked with --backend)
+and checks that each backend gives exactly the results of the plain python reference.
+
+run from the repository root:
+    python -m tools.bench_analysis                      # synthetic recordings
+    python -m tools.bench_analysis recordings --backend numpy
+"""
+import argparse
+import math
+import random
+import sys
+import time
+from array import array
+
+import analysis
+from tools.batch_analyze import find_recordings, read_recording
+
+def synthetic_recording(seconds = 30, bpm = 70, seed = 0):
+    """ppg-like test signal: a pulse and a smaller reflected wave per beat, baseline wander and noise"""
+    rnd = random.Random(seed)
+    samples = array("H")
+    next_beat = 0.3
+    beat_start = None
+
+    for i in range(seconds * 250):
+        t = i / 250
+        if t >= next_beat:
+            beat_start = t
+            next_beat = t + 60 / bpm * (1 + rnd.uniform(-0.05, 0.05))
+
+        value = 30000 + 800 * math.sin(2 * math.pi * 0.1 * t) + rnd.gauss(0, 150)
+        if beat_start is not None:
+            phase = t - beat_start
+            value += 4000 * math.exp(-((phase - 0.15) / 0.07) ** 2) + 1000 * math.exp(-((phase - 0.4) / 0.08) ** 2)
+        samples.append(max(0, min(65535, int(value))))
+
+    return samples
+
+def run_analysis(samples):
+    peaks = analysis.get_peaks(samples)
+    ppi = analysis.get_ppi(peaks)
+    hrv = analysis.calculate_hrv(ppi) if len(ppi) >= analysis.MIN_HRV_PPI_COUNT else None
+    return peaks, ppi, hrv
+
+def bench(recordings, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [run_analysis(samples) for samples in recordings]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the analysis backends")
+    parser.add_argument("directory", nargs = "?", help = "recordings to use instead of synthetic ones")
+    parser.add_argument("--backend", default = "all", help = "python, numpy, ulab, auto or all (default)")
+    parser.add_argument("--count", type = int, default = 20, help = "synthetic recordings")
+    parser.add_argument("--repeat", type = int, default = 3)
+    args = parser.parse_args(argv)
+
+    if args.directory:
+        recordings = []
+        for path in find_recordings(args.directory):
+            try:
+                recordings.append(read_recording(path))
+            except ValueError as e:
+                print(f"Skipping {path}: {e}", file = sys.stderr)
+    else:
+        recordings = [synthetic_recording(bpm = 50 + i * 5, seed = i) for i in range(args.count)]
+    total_samples = sum(len(samples) for samples in recordings)
+
+    available = sorted(analysis.available_backends())
+    if args.backend == "all":
+        names = available
+    elif args.backend == "auto":
+        analysis.set_backend("auto")
+        names = [analysis.backend_name()]
+    else:
+        names = [args.backend]
+
+    analysis.set_backend("python")
+    reference_time, reference = bench(recordings, args.repeat)
+    print(f"{len(recordings)} recordings, {total_samples} samples, available backends: {', '.join(available)}")
+
+    identical = True
+    for name in names:
+        analysis.set_backend(name)
+        elapsed, results = (reference_time, reference) if name == "python" else bench(recordings, args.repeat)
+        same = results == reference
+        identical = identical and same
+        print(f"{name:>8}: {elapsed * 1000:8.1f} ms  {total_samples / elapsed / 1e6:6.2f} Msamples/s  "
+              f"x{reference_time / elapsed:5.1f}  {'identical' if same else 'DIFFERENT RESULTS'}")
+
+    return 0 if identical else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
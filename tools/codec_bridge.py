@@ -0,0 +1,101 @@
+"""host-side bridge for the compact MQTT payloads
+
+subscribes to the "<topic>/bin" topics, decodes them with the same codec module the device uses and
+republishes the json the Kubios proxy and other consumers expect on the original topic. the bridge also
+publishes a retained caps message, which is how the devices find out that compact payloads can be sent.
+
+run from the repository root:
+    python -m tools.codec_bridge --broker 192.168.7.252 --port 21883
+
+needs paho-mqtt (pip install paho-mqtt)
+"""
+import argparse
+import json
+import sys
+
+import paho.mqtt.client as mqtt
+
+import codec
+
+def make_client(client_id):
+    # paho-mqtt 2.x wants the callback api version, 1.x does not know about it
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        return mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id)
+    return mqtt.Client(client_id)
+
+def translate(topic, payload):
+    """decode a compact payload, returns (json topic, json text)"""
+    if not topic.endswith(codec.COMPACT_SUFFIX):
+        raise ValueError(f"Not a compact topic: {topic}")
+
+    json_topic = topic[:-len(codec.COMPACT_SUFFIX)]
+    decoder = codec.DECODERS.get(json_topic)
+    if decoder is None:
+        raise ValueError(f"No decoder for topic: {json_topic}")
+
+    return json_topic, json.dumps(decoder(payload))
+
+class CodecBridge:
+    def __init__(self, broker, port, client_id = "codec-bridge"):
+        self.broker = broker
+        self.port = port
+        self.client = make_client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.translated = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # tell the devices to fall back to json once the bridge goes away
+        self.client.will_set(codec.CAPS_TOPIC, json.dumps({"version": codec.VERSION, "topics": []}), retain = True)
+
+    def caps(self):
+        return json.dumps({"version": codec.VERSION, "topics": sorted(codec.DECODERS)})
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Connecting to the broker failed: {rc}", file = sys.stderr)
+            return
+
+        for topic in codec.DECODERS:
+            client.subscribe(codec.compact_topic(topic))
+
+        client.publish(codec.CAPS_TOPIC, self.caps(), retain = True)
+        print(f"Bridging {', '.join(sorted(codec.DECODERS))}")
+
+    def on_message(self, client, userdata, message):
+        try:
+            json_topic, text = translate(message.topic, message.payload)
+        except (ValueError, KeyError, IndexError) as e:
+            print(f"Dropping payload on {message.topic}: {e}", file = sys.stderr)
+            return
+
+        client.publish(json_topic, text)
+        self.translated += 1
+        self.bytes_in += len(message.payload)
+        self.bytes_out += len(text)
+        print(f"{json_topic}: {len(message.payload)} B -> {len(text)} B")
+
+    def run(self):
+        self.client.connect(self.broker, self.port)
+        try:
+            self.client.loop_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # withdraw the caps so the devices go back to json
+            self.client.publish(codec.CAPS_TOPIC, json.dumps({"version": codec.VERSION, "topics": []}), retain = True)
+            self.client.disconnect()
+            print(f"Translated {self.translated} payloads, {self.bytes_in} B compact -> {self.bytes_out} B json")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Translate compact device payloads back to JSON")
+    parser.add_argument("--broker", default = "localhost")
+    parser.add_argument("--port", type = int, default = 1883)
+    parser.add_argument("--client-id", default = "codec-bridge")
+    args = parser.parse_args(argv)
+
+    CodecBridge(args.broker, args.port, args.client_id).run()
+
+if __name__ == "__main__":
+    main()
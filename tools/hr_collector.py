@@ -0,0 +1,369 @@
+"""host-side collector for the results the devices publish
+
+subscribes to "hr-data" and "kubios-response", validates the hr-data payloads built in
+AnalysisMeasurement.run and stores them in SQLite. rows are written in batched transactions and
+deduplicated by a hash of the whole result, so a result published twice is stored once. the id is the
+device clock, which starts over on every boot and collides between units, so it is not unique even per
+device. kubios responses are deduplicated by a hash of the payload the same way.
+
+run from the repository root:
+    python -m tools.hr_collector --broker 192.168.7.252 --port 21883 --db hr_data.sqlite3
+
+without a broker, messages can be replayed from a file of json lines {"topic": ..., "payload": ...}
+through the in-process LoopbackBroker:
+    python -m tools.hr_collector --replay messages.jsonl --db hr_data.sqlite3
+
+--self-check runs a few messages through the LoopbackBroker into an in-memory database and checks what was
+stored
+
+needs paho-mqtt (pip install paho-mqtt) when connecting to a real broker
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+
+HR_TOPIC = "hr-data"
+KUBIOS_TOPIC = "kubios-response"
+UNKNOWN_DEVICE = "unknown" # devices before the device id was added to the payload
+
+HR_TYPES = ("local", "kubios")
+HR_INT_FIELDS = ("id", "timestamp", "mean_ppi", "mean_hr", "sdnn", "rmssd")
+HR_INDEX_FIELDS = ("sns", "pns") # a number for kubios results, "---" for local ones
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hr_data (
+    result_hash TEXT PRIMARY KEY,
+    device TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    mean_ppi INTEGER NOT NULL,
+    mean_hr INTEGER NOT NULL,
+    sdnn INTEGER NOT NULL,
+    rmssd INTEGER NOT NULL,
+    sns REAL,
+    pns REAL,
+    received_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hr_data_device_id ON hr_data (device, id);
+CREATE INDEX IF NOT EXISTS hr_data_device_timestamp ON hr_data (device, timestamp);
+CREATE INDEX IF NOT EXISTS hr_data_timestamp ON hr_data (timestamp);
+CREATE TABLE IF NOT EXISTS kubios_responses (
+    payload_hash TEXT PRIMARY KEY,
+    id INTEGER NOT NULL,
+    received_at REAL NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS kubios_responses_id ON kubios_responses (id);
+"""
+
+def payload_hash(payload):
+    """hash of the canonical json, the same response published twice gets the same hash"""
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+HR_COLUMNS = ("device", "id", "timestamp", "type", "mean_ppi", "mean_hr", "sdnn", "rmssd", "sns", "pns")
+
+def result_hash(row):
+    """hash of a validated hr-data row, two measurements only share it if every value is the same"""
+    return payload_hash(json.dumps(row))
+
+def columns_of(db, table):
+    return [row[1] for row in db.execute(f"PRAGMA table_info({table})")]
+
+def migrate(db):
+    """databases from before the hash keys had hr_data keyed by (device, id) and kubios_responses by id"""
+    hr_columns = columns_of(db, "hr_data")
+    kubios_columns = columns_of(db, "kubios_responses")
+    migrate_hr = hr_columns and "result_hash" not in hr_columns
+    migrate_kubios = kubios_columns and "payload_hash" not in kubios_columns
+    if not migrate_hr and not migrate_kubios:
+        return
+
+    with db:
+        # the old indexes keep their names when a table is renamed, the new schema creates them again
+        if migrate_hr:
+            db.execute("ALTER TABLE hr_data RENAME TO hr_data_old")
+            db.execute("DROP INDEX IF EXISTS hr_data_device_timestamp")
+            db.execute("DROP INDEX IF EXISTS hr_data_timestamp")
+        if migrate_kubios:
+            db.execute("ALTER TABLE kubios_responses RENAME TO kubios_responses_old")
+            db.execute("DROP INDEX IF EXISTS kubios_responses_id")
+        db.executescript(SCHEMA)
+
+        if migrate_hr:
+            rows = db.execute(f"SELECT {', '.join(HR_COLUMNS)}, received_at FROM hr_data_old").fetchall()
+            db.executemany(
+                f"INSERT OR IGNORE INTO hr_data (result_hash, {', '.join(HR_COLUMNS)}, received_at) "
+                f"VALUES ({', '.join('?' * (len(HR_COLUMNS) + 2))})",
+                [(result_hash(row[:-1]),) + row for row in rows],
+            )
+            db.execute("DROP TABLE hr_data_old")
+        if migrate_kubios:
+            rows = db.execute("SELECT id, received_at, payload FROM kubios_responses_old").fetchall()
+            db.executemany(
+                "INSERT OR IGNORE INTO kubios_responses (payload_hash, id, received_at, payload) VALUES (?, ?, ?, ?)",
+                [(payload_hash(payload), id, received_at, payload) for id, received_at, payload in rows],
+            )
+            db.execute("DROP TABLE kubios_responses_old")
+
+def validate_hr_data(data):
+    """check an hr-data payload, returns the row to store. raises ValueError with the reason"""
+    if not isinstance(data, dict):
+        raise ValueError("payload is not an object")
+
+    for field in HR_INT_FIELDS:
+        value = data.get(field)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"{field} is not an integer: {value!r}")
+        if value < 0:
+            raise ValueError(f"{field} is negative: {value}")
+
+    if data.get("type") not in HR_TYPES:
+        raise ValueError(f"unknown type: {data.get('type')!r}")
+
+    indexes = []
+    for field in HR_INDEX_FIELDS:
+        value = data.get(field)
+        if value == "---":
+            indexes.append(None)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            indexes.append(float(value))
+        else:
+            raise ValueError(f"{field} is not a number or '---': {value!r}")
+
+    device = data.get("device", UNKNOWN_DEVICE)
+    if not isinstance(device, str) or not device:
+        raise ValueError(f"invalid device: {device!r}")
+
+    return (
+        device, data["id"], data["timestamp"], data["type"],
+        data["mean_ppi"], data["mean_hr"], data["sdnn"], data["rmssd"],
+        indexes[0], indexes[1],
+    )
+
+class LoopbackBroker:
+    """in-process stand-in for the MQTT broker, delivers every publish synchronously to the subscribers"""
+    def __init__(self):
+        self.subscribers = {}
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        for callback in self.subscribers.get(topic, ()):
+            callback(topic, payload)
+
+    def poll(self, timeout):
+        pass
+
+class PahoBroker:
+    """the same subscribe/publish/poll surface on top of a real broker"""
+    def __init__(self, host, port, client_id = "hr-collector"):
+        from tools.codec_bridge import make_client
+
+        self.subscribers = {}
+        self.client = make_client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.connect(host, port)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Connecting to the broker failed: {rc}", file = sys.stderr)
+            return
+        # subscribe again after every reconnect
+        for topic in self.subscribers:
+            client.subscribe(topic)
+
+    def on_message(self, client, userdata, message):
+        for callback in self.subscribers.get(message.topic, ()):
+            callback(message.topic, message.payload)
+
+    def subscribe(self, topic, callback):
+        self.subscribers.setdefault(topic, []).append(callback)
+        self.client.subscribe(topic)
+
+    def publish(self, topic, payload):
+        self.client.publish(topic, payload)
+
+    def poll(self, timeout):
+        self.client.loop(timeout = timeout)
+
+class Collector:
+    def __init__(self, db_path, batch_size = 500, flush_interval_s = 1.0):
+        self.db = sqlite3.connect(db_path)
+        migrate(self.db)
+        self.db.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+
+        self.pending_hr = []
+        self.pending_kubios = []
+        self.last_flush = time.monotonic()
+
+        self.received = 0
+        self.stored = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.started = time.monotonic()
+
+    def attach(self, broker):
+        broker.subscribe(HR_TOPIC, self.on_message)
+        broker.subscribe(KUBIOS_TOPIC, self.on_message)
+
+    def on_message(self, topic, payload):
+        self.received += 1
+        received_at = time.time()
+
+        try:
+            data = json.loads(payload)
+            if topic == HR_TOPIC:
+                row = validate_hr_data(data)
+                self.pending_hr.append((result_hash(row),) + row + (received_at,))
+            elif topic == KUBIOS_TOPIC:
+                if not isinstance(data, dict) or not isinstance(data.get("id"), int):
+                    raise ValueError("kubios response without an id")
+                canonical = json.dumps(data, sort_keys = True)
+                self.pending_kubios.append((payload_hash(canonical), data["id"], received_at, canonical))
+        except ValueError as e: # includes json decode errors
+            self.invalid += 1
+            print(f"Invalid payload on {topic}: {e}", file = sys.stderr)
+            return
+
+        if len(self.pending_hr) + len(self.pending_kubios) >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval_s:
+            self.flush()
+
+    def flush(self):
+        """write everything pending in one transaction"""
+        self.last_flush = time.monotonic()
+        if not self.pending_hr and not self.pending_kubios:
+            return
+
+        count = len(self.pending_hr) + len(self.pending_kubios)
+        before = self.db.total_changes
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO hr_data (result_hash, device, id, timestamp, type, mean_ppi, mean_hr, sdnn, rmssd, sns, pns, received_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending_hr,
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO kubios_responses (payload_hash, id, received_at, payload) VALUES (?, ?, ?, ?)",
+                self.pending_kubios,
+            )
+        written = self.db.total_changes - before
+
+        self.stored += written
+        self.duplicates += count - written
+        self.pending_hr.clear()
+        self.pending_kubios.clear()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.received} received, {self.stored} stored, {self.duplicates} duplicates, "
+                f"{self.invalid} invalid in {elapsed:.1f}s ({self.received / elapsed:.0f} msg/s)")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+def replay(collector, path):
+    broker = LoopbackBroker()
+    collector.attach(broker)
+
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            payload = message["payload"]
+            broker.publish(message["topic"], payload if isinstance(payload, str) else json.dumps(payload))
+
+def self_check():
+    """run messages through the LoopbackBroker into an in-memory database, returns True if all was stored right"""
+    collector = Collector(":memory:")
+    broker = LoopbackBroker()
+    collector.attach(broker)
+
+    result = {
+        "id": 120, "timestamp": 120, "type": "local", "mean_ppi": 850, "mean_hr": 71,
+        "sdnn": 42, "rmssd": 37, "sns": "---", "pns": "---", "device": "e66130100f8c2d2b",
+    }
+    after_reboot = dict(result, sdnn = 55, rmssd = 48) # same clock second after a reboot, another measurement
+    other_unit = dict(result, device = "e66130100f8c2d2c")
+    response = {"id": 120, "data": {"status": "ok", "analysis": {"mean_hr_bpm": 71.2}}}
+
+    for payload in (result, result, after_reboot, other_unit, response, response, {"id": "x"}):
+        broker.publish(KUBIOS_TOPIC if payload is response else HR_TOPIC, json.dumps(payload))
+    collector.flush()
+
+    hr_rows = collector.db.execute("SELECT device, id, sdnn FROM hr_data ORDER BY device, sdnn").fetchall()
+    kubios_rows = collector.db.execute("SELECT id FROM kubios_responses").fetchall()
+    expected_hr = [("e66130100f8c2d2b", 120, 42), ("e66130100f8c2d2b", 120, 55), ("e66130100f8c2d2c", 120, 42)]
+    checks = [
+        ("hr-data rows", hr_rows, expected_hr),
+        ("kubios-response rows", kubios_rows, [(120,)]),
+        ("duplicates", collector.duplicates, 2),
+        ("invalid", collector.invalid, 1),
+    ]
+    collector.close()
+
+    ok = True
+    for name, got, expected in checks:
+        if got != expected:
+            print(f"{name}: {got!r}, expected {expected!r}", file = sys.stderr)
+            ok = False
+    print("self check " + ("ok" if ok else "FAILED"))
+    return ok
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Collect hr-data results from the devices into SQLite")
+    parser.add_argument("--broker", default = "localhost")
+    parser.add_argument("--port", type = int, default = 1883)
+    parser.add_argument("--client-id", default = "hr-collector")
+    parser.add_argument("--db", default = "hr_data.sqlite3")
+    parser.add_argument("--batch-size", type = int, default = 500)
+    parser.add_argument("--flush-interval", type = float, default = 1.0, help = "seconds between transactions")
+    parser.add_argument("--report-interval", type = float, default = 60.0, help = "seconds between throughput reports")
+    parser.add_argument("--replay", help = "ingest json lines from a file instead of a broker")
+    parser.add_argument("--self-check", action = "store_true", help = "check the deduplication without a broker")
+    args = parser.parse_args(argv)
+
+    if args.self_check:
+        sys.exit(0 if self_check() else 1)
+
+    collector = Collector(args.db, args.batch_size, args.flush_interval)
+
+    if args.replay:
+        replay(collector, args.replay)
+        collector.close()
+        print(collector.report())
+        return
+
+    broker = PahoBroker(args.broker, args.port, args.client_id)
+    collector.attach(broker)
+    last_report = time.monotonic()
+    try:
+        while True:
+            broker.poll(timeout = 0.2)
+            collector.flush_if_due()
+            if time.monotonic() - last_report >= args.report_interval:
+                print(collector.report())
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+        print(collector.report())
+
+if __name__ == "__main__":
+    main()
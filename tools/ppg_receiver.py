@@ -0,0 +1,187 @@
+"""host-side receiver for the raw ppg stream
+
+subscribes to "ppg-stream/<device id>", reassembles the chunks of every session of every unit in sequence
+order and writes the samples to "<out>/<device>_<session>.txt", one sample per line like the filefifo
+recordings. missing sequence numbers and the samples the device lost before sending them (the sensor fifo
+overflowed) are reported as gaps and listed in "<out>/<device>_<session>.gaps.json" when the session ends. an earlier recording with the same name is never overwritten, the new one gets a
+numbered suffix instead
+
+run from the repository root:
+    python -m tools.ppg_receiver --broker 192.168.7.252 --port 21883 --out recordings
+
+needs paho-mqtt (pip install paho-mqtt)
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import codec
+from tools.codec_bridge import make_client
+
+TOPIC = "ppg-stream"
+UNKNOWN_DEVICE = "unknown" # devices publishing to the bare topic, before the device id was added
+SESSION_TIMEOUT_S = 10 # a session without chunks for this long is closed
+
+def open_new(directory, stem):
+    """create "<stem>.txt", or "<stem>-1.txt" and so on if it exists. returns (file, path without extension)"""
+    suffix = 0
+    while True:
+        base = os.path.join(directory, stem if not suffix else f"{stem}-{suffix}")
+        try:
+            return open(base + ".txt", "x"), base
+        except FileExistsError:
+            suffix += 1
+
+def device_of(topic):
+    return topic[len(TOPIC) + 1:] if topic.startswith(TOPIC + "/") else UNKNOWN_DEVICE
+
+class StreamSession:
+    def __init__(self, device, session, directory):
+        self.device = device
+        self.session = session
+        self.file, base = open_new(directory, f"{device}_{session}")
+        self.path = base + ".txt"
+        self.gaps_path = base + ".gaps.json"
+        self.expected_seq = 0
+        self.chunk_samples = 0
+        self.samples = 0
+        self.chunks = 0
+        self.duplicates = 0
+        self.gaps = [] # [seq, missing chunks, samples lost on the device, sample index of the gap]
+        self.last_seen = time.monotonic()
+
+    def add(self, seq, samples, lost = 0, lost_at = 0):
+        """returns the number of chunks missing before this one. lost samples were dropped on the device
+        before sample lost_at of the chunk"""
+        self.last_seen = time.monotonic()
+
+        if seq < self.expected_seq:
+            self.duplicates += 1 # late or repeated chunk, the samples after it are already written
+            return 0
+
+        missing = seq - self.expected_seq
+        if missing:
+            self.gaps.append([self.expected_seq, missing, 0, self.samples])
+        if lost:
+            self.gaps.append([seq, 0, lost, self.samples + lost_at])
+
+        # the last chunk of a session is shorter, so remember the size of the full ones
+        self.chunk_samples = max(self.chunk_samples, len(samples))
+        self.file.write("".join(f"{sample}\n" for sample in samples))
+        self.samples += len(samples)
+        self.chunks += 1
+        self.expected_seq = seq + 1
+        return missing
+
+    def gap_samples(self, gap):
+        return gap[1] * self.chunk_samples + gap[2]
+
+    def missing_samples(self):
+        return sum(self.gap_samples(gap) for gap in self.gaps)
+
+    def lost_on_device(self):
+        return sum(gap[2] for gap in self.gaps)
+
+    def close(self):
+        self.file.close()
+        with open(self.gaps_path, "w") as f:
+            json.dump({
+                "device": self.device,
+                "session": self.session,
+                "chunks": self.chunks,
+                "samples": self.samples,
+                "chunk_samples": self.chunk_samples,
+                "duplicates": self.duplicates,
+                "missing_samples": self.missing_samples(),
+                "lost_on_device": self.lost_on_device(),
+                "gaps": [
+                    {"seq": gap[0], "chunks": gap[1], "samples": self.gap_samples(gap), "sample_index": gap[3]}
+                    for gap in self.gaps
+                ],
+            }, f, indent = 2)
+
+class PPGReceiver:
+    def __init__(self, broker, port, directory, client_id = "ppg-receiver"):
+        self.broker = broker
+        self.port = port
+        self.directory = directory
+        self.sessions = {}
+        self.client = make_client(client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+
+        os.makedirs(directory, exist_ok = True)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print(f"Connecting to the broker failed: {rc}", file = sys.stderr)
+            return
+        client.subscribe(TOPIC + "/+")
+        client.subscribe(TOPIC)
+        print(f"Receiving {TOPIC}/+ into {self.directory}")
+
+    def on_message(self, client, userdata, message):
+        try:
+            session_id, seq, flags, samples, lost, lost_at = codec.unpack_stream_chunk(message.payload)
+        except (ValueError, IndexError) as e:
+            print(f"Dropping chunk: {e}", file = sys.stderr)
+            return
+
+        # session ids are only unique per unit
+        key = (device_of(message.topic), session_id)
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = StreamSession(key[0], session_id, self.directory)
+            print(f"Session {key} started")
+
+        missing = session.add(seq, samples, lost, lost_at)
+        if missing:
+            print(f"Session {key}: gap of {missing} chunks before seq {seq}")
+        if lost:
+            print(f"Session {key}: {lost} samples lost on the device in seq {seq}")
+
+        if flags & codec.STREAM_END:
+            self.close_session(key)
+
+    def close_session(self, key):
+        session = self.sessions.pop(key)
+        session.close()
+        print(f"Session {key} ended: {session.samples} samples, {len(session.gaps)} gaps, "
+              f"{session.missing_samples()} samples missing -> {session.path}")
+
+    def close_idle_sessions(self):
+        now = time.monotonic()
+        for key, session in list(self.sessions.items()):
+            if now - session.last_seen > SESSION_TIMEOUT_S:
+                print(f"Session {key} timed out")
+                self.close_session(key)
+
+    def run(self):
+        self.client.connect(self.broker, self.port)
+        self.client.loop_start()
+        try:
+            while True:
+                time.sleep(1)
+                self.close_idle_sessions()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.client.loop_stop()
+            self.client.disconnect()
+            for key in list(self.sessions):
+                self.close_session(key)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Reassemble raw PPG streams from the devices")
+    parser.add_argument("--broker", default = "localhost")
+    parser.add_argument("--port", type = int, default = 1883)
+    parser.add_argument("--out", default = "recordings")
+    parser.add_argument("--client-id", default = "ppg-receiver")
+    args = parser.parse_args(argv)
+
+    PPGReceiver(args.broker, args.port, args.out, args.client_id).run()
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,7 @@ import time
 import ujson
 from components.Switch import Switch
 
-def average(values):
-    return round(sum(values) / len(values)) if values else 0
-
-def stddev(values):
-    if len(values) < 2:
-        return 0
-    avg = average(values)
-    variance = sum((x - avg) ** 2 for x in values) / (len(values) - 1)
-    return variance ** 0.5
+from analysis import average, stddev # kept here for the existing imports
 
 def wait_for_press(switch, debounce_ms = 50):
     if not switch or type(switch) != Switch:
@@ -20,7 +12,7 @@ def wait_for_press(switch, debounce_ms = 50):
         time.sleep_ms(debounce_ms)
         
 def save_json(directory, data):
-    """save data to a JSON file with timestamped filename"""
+    """save data to a JSON file with timestamped filename. unbounded, use HistoryStore for the measurement history"""
     identifier = data.get('timestamp', int(time.time()))
     
     try:
@@ -30,8 +22,10 @@ def save_json(directory, data):
             f.flush()
             f.close()
         print(f"Data saved to {filename}")
+        return True
     except Exception as e:
         print(f"Error saving data to JSON: {e}")
+        return False
 
 def convert_iso_epoch(iso_string):
     iso_string = "2025-05-08T06:46:34.673110+00:00"